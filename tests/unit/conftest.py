@@ -0,0 +1,22 @@
+import pytest
+
+import usine
+
+
+@pytest.fixture
+def patch_client(monkeypatch):
+
+    def call(self, cmd, **kwargs):
+        return self._build_command(cmd, **kwargs)
+
+    def open_(self, *args, **kwargs):
+        pass
+
+    def close(self, *args, **kwargs):
+        pass
+
+    monkeypatch.setattr('usine.Client.__call__', call)
+    monkeypatch.setattr('usine.Client.open', open_)
+    monkeypatch.setattr('usine.Client.close', close)
+    with usine.connect(hostname='foo@bar'):
+        yield
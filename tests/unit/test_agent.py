@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from usine import AGENT, Agent
+
+
+class Channel:
+
+    def __init__(self, proc):
+        self.proc = proc
+
+    def sendall(self, data):
+        self.proc.stdin.write(data)
+        self.proc.stdin.flush()
+
+    def recv(self, size):
+        return os.read(self.proc.stdout.fileno(), size)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def fail(msg):
+    raise SystemExit(msg)
+
+
+@pytest.fixture
+def agent(tmp_path):
+    path = tmp_path / 'agent.py'
+    path.write_text(AGENT)
+    proc = subprocess.Popen([sys.executable, str(path)],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    agent = Agent(Channel(proc), fail)
+    yield agent
+    agent.close()
+
+
+def test_agent_removes_its_script(agent, tmp_path):
+    assert agent('ping') == 'pong'
+    assert not (tmp_path / 'agent.py').exists()
+
+
+def test_agent_filesystem_ops(agent, tmp_path):
+    path = tmp_path / 'foo' / 'bar'
+    assert not agent('exists', str(path))
+    agent('mkdir', str(path))
+    assert agent('exists', str(path))
+    assert agent('stat', str(path))['is_dir']
+    (path / 'file').write_text('data')
+    agent('copy', str(path / 'file'), str(tmp_path))
+    assert (tmp_path / 'file').read_text() == 'data'
+    agent('rename', str(tmp_path / 'file'), str(tmp_path / 'other'))
+    assert [e['name'] for e in agent('listdir', str(tmp_path))] == \
+        ['foo', 'other']
+    other = agent('listdir', str(tmp_path / 'other'))
+    assert [(e['name'], e['size']) for e in other] == \
+        [(str(tmp_path / 'other'), 4)]
+    assert agent('hash', str(tmp_path / 'other'), 'md5') == \
+        '8d777f385d3dfec8815d20f7496026dc'
+    assert agent('stat', str(tmp_path / 'missing')) is None
+
+
+def test_agent_errors(agent, tmp_path):
+    with pytest.raises(SystemExit):
+        agent('mkdir', str(tmp_path / 'a' / 'b'), parents=False)
+
+
+def test_agent_batch(agent, tmp_path):
+    responses = agent.batch([('exists', [str(tmp_path)], {}),
+                             ('listdir', [str(tmp_path / 'missing')], {})])
+    assert responses[0] == {'result': True}
+    assert 'FileNotFoundError' in responses[1]['error']
@@ -0,0 +1,82 @@
+import pytest
+
+import usine
+from usine import TokenBucket, parse_size
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = {'now': 0, 'slept': 0}
+
+    def sleep(duration):
+        clock['now'] += duration
+        clock['slept'] += duration
+
+    monkeypatch.setattr('time.monotonic', lambda: clock['now'])
+    monkeypatch.setattr('time.sleep', sleep)
+    return clock
+
+
+def test_parse_size():
+    assert parse_size(None) is None
+    assert parse_size(512) == 512
+    assert parse_size('64K') == 64 * 1024
+    assert parse_size('1.5M') == 1536 * 1024
+    assert parse_size('2GB') == 2 * 1024 ** 3
+
+
+def test_unlimited_bucket_does_not_wait(clock):
+    bucket = TokenBucket()
+    bucket.consume(10 ** 9)
+    assert clock['slept'] == 0
+    assert bucket.transferred == 10 ** 9
+
+
+def test_bucket_limits_rate(clock):
+    bucket = TokenBucket(rate='1M', burst=1024)
+    bucket.consume(10 * 1024 ** 2)
+    assert clock['slept'] == pytest.approx(10)
+    assert bucket.throughput == pytest.approx(1024 ** 2)
+
+
+def test_bucket_rate_can_change(clock):
+    bucket = TokenBucket(rate=1000, burst=100)
+    bucket.consume(1000)
+    bucket.rate = 2000
+    bucket.consume(1000)
+    assert clock['slept'] == pytest.approx(1.5, abs=0.1)
+
+
+def test_bucket_rate_is_parsed_when_changed(clock):
+    bucket = TokenBucket(burst=1024)
+    bucket.rate = '1K'
+    assert bucket.rate == 1024
+    bucket.consume(2048)
+    assert clock['slept'] == pytest.approx(2)
+
+
+def test_throttle_context_manager(patch_client):
+    assert usine.client.bandwidth.rate is None
+    with usine.throttle('10M'):
+        assert usine.client.bandwidth.rate == 10 * 1024 ** 2
+        assert usine.client.throttled
+    assert not usine.client.throttled
+
+
+def test_throttled_get_joins_cd_once(patch_client, monkeypatch, tmp_path):
+    calls = []
+    monkeypatch.setattr('usine._get', lambda remote, local, position:
+                        calls.append(str(remote)))
+    with usine.throttle('1M'), usine.cd('app'):
+        usine.get('file', tmp_path / 'file')
+    assert calls == ['app/file']
+
+
+def test_throughput_ignores_idle_gaps(clock):
+    bucket = TokenBucket(rate=1000, burst=100)
+    bucket.consume(1000)
+    assert bucket.throughput == pytest.approx(1000, rel=0.15)
+    clock['now'] += 3600  # Idle between two steps.
+    bucket.consume(1000)
+    assert bucket.throughput == pytest.approx(1000, rel=0.15)
+    assert bucket.transferred == 2000
@@ -0,0 +1,103 @@
+import sys
+import time
+
+import pytest
+from paramiko.config import SSHConfig
+
+import usine
+from usine import Bastion
+
+
+@pytest.fixture
+def bastions(monkeypatch):
+    connected = []
+
+    class Client:
+
+        def close(self):
+            connected.remove(self.args[0])
+
+    def connect(self, *args, sock=None):
+        self.args = args
+        self.sock = sock
+        self._client = Client()
+        self._client.args = args
+        connected.append(args[0])
+
+    monkeypatch.setattr('usine.Bastion.connect', connect)
+    monkeypatch.setattr('usine.Bastion.is_active', lambda self: True)
+    monkeypatch.setattr('usine.Bastion.open_channel',
+                        lambda self, host, port: (self.args[0], host, port))
+    yield connected
+    Bastion.pool.clear()
+
+
+def test_bastion_is_shared_by_targets(bastions):
+    config = SSHConfig.from_text('Host jump\n  HostName 10.0.0.1\n  Port 2222')
+    chain1 = Bastion.acquire(['me@jump'], config)
+    chain2 = Bastion.acquire(['me@jump'], config)
+    assert chain1[0] is chain2[0]
+    assert chain1[0].args == ('10.0.0.1', 'me', 2222, [])
+    assert bastions == ['10.0.0.1']
+    Bastion.release(chain1)
+    assert bastions == ['10.0.0.1']
+    Bastion.release(chain2)
+    assert bastions == []
+
+
+def test_chained_jumps(bastions):
+    config = SSHConfig.from_text('')
+    first, second = Bastion.acquire(['a', 'b:2200'], config)
+    assert first.sock is None
+    assert second.sock == ('a', 'b', 2200)
+    other = Bastion.acquire(['a'], config)
+    assert other[0] is first
+    Bastion.release([first, second])
+    assert bastions == ['a']
+
+
+def test_failing_hop_releases_previous_ones(bastions, monkeypatch):
+    connect = Bastion.connect
+
+    def failing(self, *args, sock=None):
+        if args[0] == 'b':
+            raise EOFError()
+        connect(self, *args, sock=sock)
+
+    monkeypatch.setattr('usine.Bastion.connect', failing)
+    with pytest.raises(EOFError):
+        Bastion.acquire(['a', 'b'], SSHConfig.from_text(''))
+    assert bastions == []
+    assert not Bastion.pool
+
+
+def test_failing_target_releases_bastions(bastions, monkeypatch):
+    def fail(self, settings, timings):
+        sys.exit('Connection error')
+
+    monkeypatch.setattr('usine.Client._connect', fail)
+    client = usine.Client('foo@bar', lazy=True)
+    client.proxy_jump = ['a']
+    with pytest.raises(SystemExit):
+        client.open()
+    assert bastions == []
+    assert client._jumps is None
+
+
+def test_jump_max_targets_limits_handshakes(bastions, monkeypatch):
+    monkeypatch.setitem(usine.config, 'jump_max_targets', 1)
+    monkeypatch.setitem(usine.config, 'proxy_jump', 'a')
+    active = []
+
+    def handshake(self, sock, settings):
+        active.append(self.hostname)
+        assert len(active) == 1
+        time.sleep(0.01)
+        active.remove(self.hostname)
+
+    monkeypatch.setattr('usine.Client._handshake', handshake)
+    monkeypatch.setattr('paramiko.SSHClient.get_transport', lambda self: None)
+    monkeypatch.setattr('usine.Client._apply_profile', lambda self, s: None)
+    clients = usine.connect_many(['foo@one', 'foo@two', 'foo@three'])
+    assert len(clients) == 3
+    assert bastions == ['a']
@@ -0,0 +1,97 @@
+import pytest
+
+import usine
+from usine import Status, StatusCache
+
+call = usine.Client.__call__  # Before patch_client replaces it.
+
+
+@pytest.fixture
+def runs(patch_client, monkeypatch):
+    runs = []
+
+    def _run(self, cmd, **kwargs):
+        runs.append(self._build_command(cmd))
+        return Status(f'output {len(runs)}', '', 0)
+
+    monkeypatch.setattr('usine.Client.__call__', call)
+    monkeypatch.setattr('usine.Client._run', _run)
+    return runs
+
+
+def test_lru_eviction_by_size():
+    cache = StatusCache(max_size=10)
+    cache.set(('default', 'a'), Status('aaaa', '', 0))
+    cache.set(('default', 'b'), Status('bbbb', '', 0))
+    cache.get(('default', 'a'))
+    cache.set(('default', 'c'), Status('cccc', '', 0))
+    assert cache.get(('default', 'b')) is None
+    assert cache.get(('default', 'a'))
+    assert cache.size == 8
+    cache.set(('default', 'd'), Status('too long to be cached', '', 0))
+    assert len(cache) == 2
+
+
+def test_clear_namespace():
+    cache = StatusCache()
+    cache.set(('git', 'a'), Status('a', '', 0))
+    cache.set(('default', 'b'), Status('b', '', 0))
+    cache.clear('git')
+    assert cache.get(('git', 'a')) is None
+    assert cache.get(('default', 'b'))
+    assert cache.size == 1
+
+
+def test_run_cache(runs):
+    first = usine.run('cat /etc/os-release', cache=True)
+    assert usine.run('cat /etc/os-release', cache=True) is first
+    assert len(runs) == 1
+
+
+def test_cache_key_includes_context(runs):
+    usine.run('whoami', cache=True)
+    with usine.sudo():
+        usine.run('whoami', cache=True)
+    assert len(runs) == 2
+
+
+def test_mutating_command_clears_cache(runs):
+    usine.run('git rev-parse HEAD', cache=True)
+    with usine.sudo():
+        usine.exists('/tmp')  # Read only.
+    usine.run('git rev-parse HEAD', cache=True)
+    assert len(runs) == 2
+    usine.run('git pull')
+    usine.run('git rev-parse HEAD', cache=True)
+    assert len(runs) == 4
+
+
+def test_cached_remote(runs):
+
+    @usine.cached_remote
+    def revision():
+        return usine.run('git rev-parse HEAD')
+
+    @usine.cached_remote('os')
+    def release():
+        return usine.run('cat /etc/os-release')
+
+    assert revision() is revision()
+    release()
+    usine.clear_cache('default')
+    revision()
+    release()
+    assert len(runs) == 3
+
+
+def test_cache_opt_out_and_stdin(runs):
+
+    @usine.cached_remote
+    def check():
+        usine.run('uptime', cache=False)
+        usine.run('cat', stdin=b'data')
+
+    check()
+    check()
+    assert len(runs) == 4
+    assert len(usine.client.cache) == 0
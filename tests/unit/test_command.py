@@ -1,27 +1,10 @@
+import sys
+
 import pytest
 
 import usine
 
 
-@pytest.fixture
-def patch_client(monkeypatch):
-
-    def call(self, cmd, **kwargs):
-        return self._build_command(cmd, **kwargs)
-
-    def open_(self, *args, **kwargs):
-        pass
-
-    def close(self, *args, **kwargs):
-        pass
-
-    monkeypatch.setattr('usine.Client.__call__', call)
-    monkeypatch.setattr('usine.Client.open', open_)
-    monkeypatch.setattr('usine.Client.close', close)
-    with usine.connect(hostname='foo@bar'):
-        yield
-
-
 def test_hostname_parsing(patch_client):
     assert usine.client.username == 'foo'
     assert usine.client.hostname == 'bar'
@@ -72,3 +55,192 @@ def test_unsudo(patch_client):
     with usine.sudo():
         with usine.unsudo():
             assert usine.run('whoami') == "sh -c $'whoami'"
+
+
+def test_submit_captures_context(patch_client, monkeypatch):
+    monkeypatch.setattr('usine.Client._background',
+                        lambda self, command, stdin: command.cmd)
+    with usine.sudo():
+        future = usine.submit('whoami')
+    assert future.result() == \
+        "sudo --set-home --preserve-env  sh -c $'whoami'"
+
+
+def test_gather_dry_run(patch_client):
+    usine.client.dry_run = True
+    futures = [usine.submit('whoami'), usine.submit('uptime')]
+    assert [bool(s) for s in usine.gather(*futures)] == [True, True]
+
+
+@pytest.fixture
+def executed(patch_client, monkeypatch):
+    """Record the silently run commands, with a readable /tmp/a file."""
+    executed = []
+
+    def _exec(self, cmd):
+        executed.append(cmd)
+        if 'if [ -d /tmp/a ]' in cmd:
+            return usine.Status('file\n', '', 0)
+        if 'du -sb' in cmd:
+            return usine.Status('42\t/tmp/a', '', 0)
+        return usine.Status('', '', 0)
+
+    monkeypatch.setattr('usine.Client._exec', _exec)
+    return executed
+
+
+TMP = usine.staging_path('/tmp/b')
+
+
+def test_transfer_direct(executed, monkeypatch):
+    commands = []
+
+    def call(self, cmd):
+        commands.append(self._build_command(cmd))
+        return usine.Status('', '', 0)
+
+    monkeypatch.setattr('usine.Client.__call__', call)
+    other = usine.Client('baz@qux')
+    with usine.sudo():
+        ret = usine.transfer(other, '/tmp/a', usine.client, '/tmp/b',
+                             direct=True)
+    cmd, = commands
+    assert cmd.startswith("sh -c $'(cat /tmp/a; echo $? > /tmp/usine-")
+    assert ("| ssh -p 22 foo@bar \"sudo --set-home --preserve-env sh -c "
+            f"$\\'cat > {TMP}\\'\"; code=$?;") in cmd
+    assert executed[-1].endswith(f"$'mv {TMP} /tmp/b'")
+    assert ret.data['size'] == 42
+
+
+def test_transfer_direct_failure_drops_received_data(executed, monkeypatch):
+    monkeypatch.setattr('usine.Client.__call__',
+                        lambda self, cmd: sys.exit(1))
+    other = usine.Client('baz@qux')
+    with pytest.raises(SystemExit):
+        usine.transfer(other, '/tmp/a', usine.client, '/tmp/b', direct=True)
+    assert executed[-1] == f"sh -c $'rm -rf {TMP}'"
+
+
+def test_transfer_missing_source(executed):
+    other = usine.Client('baz@qux')
+    with pytest.raises(SystemExit):
+        usine.transfer(other, '/tmp/missing', usine.client, '/tmp/b')
+    assert len(executed) == 1
+
+
+class Channel:
+
+    def __init__(self, chunks=(), stderr=b''):
+        self.chunks = list(chunks)
+        self.stderr = stderr
+        self.received = bytearray()
+        self.closed_write = False
+        self.code = 0
+
+    @property
+    def eof_received(self):
+        return not self.chunks
+
+    def exec_command(self, cmd):
+        pass
+
+    def recv_ready(self):
+        return bool(self.chunks)
+
+    def recv(self, size):
+        return self.chunks.pop(0)
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv_stderr(self, size):
+        data, self.stderr = self.stderr, b''
+        return data
+
+    def send_ready(self):
+        return True
+
+    def send(self, data):
+        self.received += data[:3]  # Partial sends.
+        return min(len(data), 3)
+
+    def shutdown_write(self):
+        self.closed_write = True
+
+    def exit_status_ready(self):
+        return self.closed_write or not self.chunks
+
+    def recv_exit_status(self):
+        return self.code
+
+    def close(self):
+        pass
+
+
+def transfer_streaming(monkeypatch, source, dest):
+    dest.exit_status_ready = lambda: dest.closed_write
+    sessions = iter([source, dest])
+    monkeypatch.setattr('usine.Client.open_session',
+                        lambda self: next(sessions))
+    other = usine.Client('baz@qux')
+    return usine.transfer(other, '/tmp/a', usine.client, '/tmp/b')
+
+
+def test_transfer_streams_and_drains_stderr(executed, monkeypatch):
+    source = Channel([b'hello ', b'world'], stderr=b'warning')
+    dest = Channel(stderr=b'x' * 10)
+    ret = transfer_streaming(monkeypatch, source, dest)
+    assert dest.received == b'hello world'
+    assert not source.stderr and not dest.stderr
+    assert ret.data['size'] == 11
+    assert executed[-1] == f"sh -c $'mv {TMP} /tmp/b'"
+
+
+def test_transfer_streaming_failure_drops_received_data(executed,
+                                                        monkeypatch):
+    source = Channel([b'hello'], stderr=b'read error')
+    source.code = 2
+    with pytest.raises(SystemExit):
+        transfer_streaming(monkeypatch, source, Channel())
+    assert executed[-1] == f"sh -c $'rm -rf {TMP}'"
+
+
+def test_persistent_shell_failure_shows_output(patch_client, monkeypatch,
+                                               capsys):
+    shell = usine.Shell.__new__(usine.Shell)
+    shell.prefix = 'sudo '
+    monkeypatch.setattr('usine.Shell.__call__', lambda self, cmd, write:
+                        usine.Status('step 1\nno such file\n', '', 2))
+    monkeypatch.setattr('usine.Client.ensure_alive', lambda self: None)
+    usine.client._shells[''] = shell
+    with pytest.raises(SystemExit):
+        usine.client._run('ls /missing')
+    assert 'step 1\nno such file' in capsys.readouterr().out
+    usine.client._shells.clear()
+
+
+def test_human_size():
+    assert usine.human_size(12) == '12.0 B'
+    assert usine.human_size(2048) == '2.0 KiB'
+    assert usine.human_size(3 * 1024 ** 3) == '3.0 GiB'
+
+
+def test_sudo_persistent_shell(patch_client, monkeypatch):
+    monkeypatch.setattr('usine.Shell.__init__',
+                        lambda self, channel, prefix: setattr(self, 'prefix',
+                                                              prefix))
+    monkeypatch.setattr('usine.Shell.close', lambda self: None)
+    monkeypatch.setattr('usine.Shell.__call__',
+                        lambda self, cmd, write: usine.Status('', '', 0))
+    usine.client._transport = type('Transport', (), {
+        'is_active': lambda self: True,
+        'open_session': lambda self, timeout=None: None})()
+    with usine.sudo(persistent=True):
+        shell = usine.client._get_shell()
+        assert shell.prefix == 'sudo --set-home --preserve-env  '
+        with usine.sudo(persistent=True):
+            assert usine.client._get_shell() is shell
+        with usine.unsudo():
+            assert not usine.client._get_shell()
+        assert not usine.client._get_shell(stdin=b'data')
+    assert not usine.client._shells
@@ -0,0 +1,91 @@
+import threading
+
+import paramiko
+import pytest
+
+import usine
+from usine import ProfiledSSHClient, connect_many, load_key, read_cache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr('usine.CACHE_DIR', tmp_path)
+    return tmp_path
+
+
+class Transport:
+
+    def __init__(self, accepted):
+        self.accepted = accepted
+        self.tried = []
+        self.authenticated = False
+
+    def start_client(self, timeout=None):
+        pass
+
+    def auth_publickey(self, username, key):
+        self.tried.append(key)
+        if key != self.accepted:
+            raise paramiko.AuthenticationException('denied')
+        self.authenticated = True
+
+    def is_authenticated(self):
+        return self.authenticated
+
+
+def authenticate(accepted, keys):
+    timings = {}
+    ssh = ProfiledSSHClient('foo@bar:22', timings)
+    ssh.started = 0
+    ssh._transport = Transport(accepted)
+    ssh._transport.start_client()  # Wrapped to time the key exchange.
+    ssh._auth('foo', None, None, keys, False, False, None)
+    assert set(timings) == {'kex', 'hostkey', 'auth'}
+    return ssh._transport.tried
+
+
+def test_load_key(tmp_path):
+    path = tmp_path / 'id_rsa'
+    paramiko.RSAKey.generate(1024).write_private_key_file(str(path))
+    assert isinstance(load_key(str(path)), paramiko.RSAKey)
+    assert load_key(str(tmp_path / 'missing')) is None
+
+
+def test_auth_tries_last_successful_key_first(cache, monkeypatch):
+    monkeypatch.setattr('usine.load_key', lambda path: path)
+    keys = ['/keys/a', '/keys/b', '/keys/c']
+    assert authenticate('/keys/c', keys) == keys
+    assert read_cache('auth') == {'foo@bar:22': '/keys/c'}
+    assert authenticate('/keys/c', keys) == ['/keys/c']
+
+
+def test_auth_falls_back_to_paramiko(cache, monkeypatch):
+    monkeypatch.setattr('usine.load_key', lambda path: None)
+    fallback = []
+
+    def _auth(self, username, password, pkey, key_filenames, *args):
+        fallback.extend(key_filenames)
+
+    monkeypatch.setattr('paramiko.SSHClient._auth', _auth)
+    assert authenticate(None, ['/keys/encrypted']) == []
+    assert fallback == ['/keys/encrypted']
+    assert read_cache('auth') == {}
+
+
+def test_connect_many_opens_concurrently(monkeypatch):
+    barrier = threading.Barrier(3, timeout=5)
+
+    def open_(self):
+        barrier.wait()  # Would time out if connections were sequential.
+        self.stats['connect'] = {'total': 0}
+
+    monkeypatch.setattr('usine.Client.open', open_)
+    clients = connect_many(['foo@one', 'foo@two', 'foo@three'])
+    assert [c.hostname for c in clients] == ['one', 'two', 'three']
+    assert all(c.stats['connect'] for c in clients)
+
+
+def test_lazy_client_does_not_connect(monkeypatch):
+    monkeypatch.setattr('usine.Client.open', lambda self: 1 / 0)
+    client = usine.Client('foo@bar', lazy=True)
+    assert client.stats == {}
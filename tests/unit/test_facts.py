@@ -0,0 +1,80 @@
+import subprocess
+
+import pytest
+
+import usine
+from usine import FACTS, fact, parse_probe, probe_script
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr('usine.CACHE_DIR', tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def probe(patch_client, cache, monkeypatch):
+    calls = []
+
+    def _exec(self, cmd, stdin=None):
+        calls.append(stdin)
+        output = subprocess.run(['sh', '-s'], input=stdin.encode(),
+                                stdout=subprocess.PIPE).stdout.decode()
+        return usine.Status(output, '', 0)
+
+    monkeypatch.setattr('usine.Client._exec', _exec)
+    return calls
+
+
+def test_probe_roundtrip():
+    script = probe_script('marker', ['hostname', 'kernel', 'user'])
+    output = subprocess.run(['sh', '-s'], input=script.encode(),
+                            stdout=subprocess.PIPE).stdout.decode()
+    facts = parse_probe(output, 'marker')
+    assert set(facts) == {'hostname', 'kernel', 'user'}
+    assert facts['kernel']['name'] == 'Linux'
+    assert isinstance(facts['user']['uid'], int)
+
+
+def test_parse_failure_gives_none():
+    assert parse_probe('\nmarker kernel\n\n', 'marker') == {'kernel': None}
+
+
+def test_builtin_parsers():
+    assert FACTS['os'][1]('NAME="Debian GNU/Linux"\nVERSION_ID="12"') == \
+        {'name': 'Debian GNU/Linux', 'version_id': '12'}
+    assert FACTS['python'][1]('Python 3.11.2') == '3.11.2'
+    assert FACTS['python'][1]('sh: python3: not found') is None
+    disks = FACTS['disk'][1](
+        'Filesystem 1024-blocks Used Available Capacity Mounted on\n'
+        '/dev/sda1 1000 400 600 40% /')
+    assert disks == [{'filesystem': '/dev/sda1', 'size': 1024000,
+                      'used': 409600, 'available': 614400,
+                      'mountpoint': '/'}]
+
+
+def test_facts_are_cached(probe):
+    assert usine.facts()['kernel']['name'] == 'Linux'
+    assert usine.client.facts is usine.facts()
+    assert len(probe) == 1
+    usine.client._facts = None  # Only the file cache remains.
+    usine.facts()
+    assert len(probe) == 1
+    usine.facts(refresh=True)
+    assert len(probe) == 2
+
+
+def test_facts_ttl(probe, monkeypatch):
+    monkeypatch.setitem(usine.config, 'facts_ttl', -1)
+    usine.facts()
+    usine.facts()
+    assert len(probe) == 2
+
+
+def test_custom_fact_joins_the_probe(probe, monkeypatch):
+    usine.facts()
+    monkeypatch.setitem(FACTS, 'answer', FACTS['hostname'])
+    fact('answer', 'echo 42')(int)
+    assert usine.facts()['answer'] == 42
+    assert len(probe) == 2
+    assert 'echo 42' in probe[1] and 'uname' in probe[1]
@@ -0,0 +1,103 @@
+import errno
+
+import pytest
+
+import usine
+from usine import SFTPFS, ShellFS, sftp_path
+
+
+class SFTP:
+
+    def __init__(self, *paths):
+        self.paths = {path: 0o40755 for path in paths}
+        self.calls = []
+
+    def stat(self, path):
+        if path not in self.paths:
+            raise IOError(errno.ENOENT, 'No such file')
+        return type('Attrs', (), {'st_mode': self.paths[path]})
+
+    def mkdir(self, path, mode):
+        self.calls.append(('mkdir', path, mode))
+        self.paths[path] = 0o40000 | mode
+
+    def posix_rename(self, src, dest):
+        self.calls.append(('posix_rename', src, dest))
+
+
+@pytest.fixture
+def sftp(patch_client, monkeypatch):
+    sftp = SFTP('/srv', '/srv/dir')
+    monkeypatch.setattr('usine.Client.sftp', sftp)
+    usine.client._transport = type('Transport', (),
+                                   {'is_active': lambda self: True})()
+    return sftp
+
+
+def test_sftp_path():
+    assert sftp_path('~') == '.'
+    assert sftp_path('~/foo') == 'foo'
+    assert sftp_path('/foo') == '/foo'
+
+
+def test_fs_is_sftp_by_default(sftp):
+    assert isinstance(usine.client.fs, SFTPFS)
+
+
+def test_fs_falls_back_to_shell_with_sudo(sftp):
+    with usine.sudo():
+        assert type(usine.client.fs) is ShellFS
+        assert usine.mkdir('/srv/foo') == \
+            "sudo --set-home --preserve-env  sh -c $'mkdir --parents /srv/foo'"
+    assert not sftp.calls
+
+
+def test_sftp_exists(sftp):
+    assert usine.exists('/srv/dir')
+    assert not usine.exists('/srv/missing')
+    with usine.cd('/srv'):
+        assert usine.exists('dir')
+
+
+def test_sftp_stat_raises_when_connection_is_lost(sftp):
+    usine.client._transport.is_active = lambda: False
+    with pytest.raises(IOError):
+        usine.client.fs.stat('/srv/missing')
+
+
+def test_sftp_mkdir_parents(sftp):
+    usine.mkdir('/srv/foo/bar', mode=750)
+    assert sftp.calls == [('mkdir', '/srv/foo', 0o750),
+                          ('mkdir', '/srv/foo/bar', 0o750)]
+
+
+def test_sftp_mkdir_parents_in_home_cd(sftp):
+    sftp.paths['app'] = 0o40755
+    with usine.cd('~/app'):
+        usine.mkdir('static/css')
+    assert sftp.calls == [('mkdir', 'app/static', 0o777),
+                          ('mkdir', 'app/static/css', 0o777)]
+
+
+def test_sftp_mkdir_symbolic_mode_uses_shell(sftp):
+    assert usine.mkdir('/srv/foo', mode='u+rwx') == \
+        "sh -c $'mkdir --parents --mode=u+rwx /srv/foo'"
+
+
+def test_sftp_mv_into_directory(sftp):
+    usine.mv('/srv/file', '/srv/dir')
+    assert sftp.calls == [('posix_rename', '/srv/file', '/srv/dir/file')]
+
+
+def test_failed_put_removes_partial_file(sftp, monkeypatch, tmp_path):
+    def put(local, remote, callback, confirm):
+        raise OSError('No space left on device')
+
+    sftp.put = put
+    sftp.remove = lambda path: sftp.calls.append(('remove', path))
+    local = tmp_path / 'index.html'
+    local.write_text('<html>')
+    with pytest.raises(SystemExit):
+        usine.put(local, '/srv/index.html')
+    tmp = str(usine.staging_path('/srv/index.html'))
+    assert sftp.calls == [('remove', tmp)]
@@ -0,0 +1,104 @@
+import os
+import subprocess
+
+import pytest
+from paramiko.message import Message
+from paramiko.sftp import CMD_ATTRS, CMD_STATUS
+from paramiko.sftp_attr import SFTPAttributes
+
+import usine
+
+
+@pytest.fixture
+def shell(patch_client, monkeypatch):
+    """Run the built commands locally."""
+
+    def call(self, cmd, **kwargs):
+        cmd = self._build_command(cmd, **kwargs)
+        proc = subprocess.run(['bash', '-c', cmd], stdout=subprocess.PIPE)
+        return usine.Status(proc.stdout.decode(), '', proc.returncode)
+
+    monkeypatch.setattr('usine.Client.__call__', call)
+    # Force the shell backend.
+    monkeypatch.setattr('usine.Client.fs',
+                        property(lambda self: usine.ShellFS(self)))
+
+
+@pytest.fixture
+def files(tmp_path):
+    (tmp_path / 'file').write_text('data')
+    (tmp_path / 'dir').mkdir()
+    return [str(tmp_path / name) for name in ('file', 'dir', 'missing')]
+
+
+def test_shell_exists_many(shell, files):
+    assert usine.exists_many(files) == dict(zip(files, [True, True, False]))
+
+
+def test_shell_exists_many_respects_cd(shell, files, tmp_path):
+    with usine.cd(str(tmp_path)):
+        assert usine.exists_many(['file', 'missing']) == \
+            {'file': True, 'missing': False}
+
+
+def test_shell_stat_many(shell, files):
+    stats = usine.stat_many(files)
+    assert stats[files[0]]['size'] == 4
+    assert not stats[files[0]]['is_dir']
+    assert stats[files[1]]['is_dir']
+    assert stats[files[0]]['uid'] == os.getuid()
+    assert stats[files[2]] is None
+
+
+def test_shell_hash_many(shell, files):
+    assert usine.hash_many(files[::2], algorithm='md5') == {
+        files[0]: '8d777f385d3dfec8815d20f7496026dc', files[2]: None}
+
+
+def test_shell_many_dry_run(shell, files):
+    usine.client.dry_run = True
+    assert usine.exists_many(files) == dict.fromkeys(files, False)
+    assert usine.stat_many(files) == dict.fromkeys(files)
+
+
+class SFTP:
+
+    def __init__(self, *paths):
+        self.paths = paths
+        self.pending = []
+        self.reads = 0
+
+    def _adjust_cwd(self, path):
+        return path
+
+    def _async_request(self, fileobj, t, path):
+        self.pending.append((fileobj, len(self.pending), path))
+        return len(self.pending) - 1
+
+    def _read_response(self):
+        # Answer in reverse order.
+        fileobj, num, path = self.pending.pop()
+        self.reads += 1
+        msg = Message()
+        if path in self.paths:
+            attrs = SFTPAttributes()
+            attrs.st_size, attrs.st_mode = 10, 0o100644
+            attrs.st_uid = attrs.st_gid = 1000
+            attrs.st_atime = attrs.st_mtime = 0
+            attrs._pack(msg)
+            t = CMD_ATTRS
+        else:
+            msg.add_int(2)
+            t = CMD_STATUS
+        fileobj._async_response(t, Message(msg.asbytes()), num)
+
+
+def test_sftp_stat_many_is_pipelined(patch_client, monkeypatch):
+    sftp = SFTP('/a', '/c')
+    monkeypatch.setattr('usine.Client.sftp', sftp)
+    stats = usine.stat_many(['/a', '/b', '/c'])
+    assert stats['/a']['size'] == 10
+    assert stats['/b'] is None
+    assert not stats['/c']['is_dir']
+    assert sftp.reads == 3
+    assert usine.exists_many(['/a', '/b']) == {'/a': True, '/b': False}
@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+from usine import (Command, JSONLinesSink, LogSink, QuietSink, Status,
+                   TerminalSink)
+
+
+class Client:
+    hostname = 'myhost'
+
+
+@pytest.fixture
+def command():
+    return Command(Client(), 'ls')
+
+
+def test_terminal_coalesces_writes(command, capsys, monkeypatch):
+    now = [0]
+    monkeypatch.setattr('time.monotonic', lambda: now[0])
+    sink = TerminalSink(interval=1)
+    sink.start(command)
+    capsys.readouterr()
+    sink.write(command, b'foo\n')
+    sink.write(command, b'bar\n')
+    assert capsys.readouterr().out == ''
+    now[0] = 2
+    sink.write(command, 'é'.encode()[:1])  # Partial char.
+    assert capsys.readouterr().out == 'foo\nbar\n'
+    sink.write(command, 'é'.encode()[1:])
+    sink.idle(command)
+    assert capsys.readouterr().out == 'é'
+    sink.write(command, b'end')
+    sink.finish(command, Status('', '', 0))
+    assert capsys.readouterr().out == 'end'
+
+
+def test_terminal_prefixed_lines(capsys):
+    first = Command(Client(), 'ls', prefix='[1] ')
+    second = Command(Client(), 'ls', prefix='[2] ')
+    sink = TerminalSink()
+    sink.start(first)
+    sink.start(second)
+    capsys.readouterr()
+    sink.write(first, b'foo\nba')
+    sink.write(second, b'baz\n')
+    sink.write(first, b'r\n')
+    sink.write(second, b'end')
+    sink.finish(second, Status('', '', 0))
+    assert capsys.readouterr().out == '[1] foo\n[2] baz\n[1] bar\n[2] end\n'
+
+
+def test_quiet_only_shows_failures(command, capsys):
+    sink = QuietSink()
+    sink.start(command)
+    sink.write(command, b'output')
+    sink.finish(command, Status('output', '', 0))
+    assert capsys.readouterr().out == ''
+    sink.start(command)
+    sink.write(command, b'error')
+    sink.finish(command, Status('error', '', 1))
+    assert 'ls' in capsys.readouterr().out
+
+
+def test_log_per_host(command, tmp_path):
+    sink = LogSink(tmp_path)
+    sink.start(command)
+    sink.write(command, b'foo\n')
+    sink.finish(command, Status('foo\n', '', 0))
+    sink.close()
+    assert (tmp_path / 'myhost.log').read_text() == '$ ls\nfoo\n\n[exit 0]\n'
+
+
+def test_log_per_command(command, tmp_path):
+    sink = LogSink(tmp_path, per_command=True)
+    sink.start(command)
+    sink.write(command, b'foo\n')
+    sink.finish(command, Status('foo\n', '', 0))
+    assert not sink.files
+    path = tmp_path / 'myhost' / f'{command.id:05d}.log'
+    assert path.read_text() == '$ ls\nfoo\n\n[exit 0]\n'
+
+
+def test_json_lines(command, tmp_path):
+    sink = JSONLinesSink(tmp_path / 'log.jsonl')
+    sink.start(command)
+    sink.write(command, b'foo')
+    sink.finish(command, Status('foo', 'oops', 2))
+    sink.close()
+    record = json.loads((tmp_path / 'log.jsonl').read_text())
+    assert record['host'] == 'myhost'
+    assert record['command'] == 'ls'
+    assert record['stdout'] == 'foo'
+    assert record['stderr'] == 'oops'
+    assert record['code'] == 2
+
+
+def test_json_lines_shared_by_clients(tmp_path):
+    sinks = [JSONLinesSink(tmp_path / 'log.jsonl') for _ in range(2)]
+    commands = [Command(Client(), 'ls') for _ in range(2)]
+    commands[1].hostname = 'otherhost'
+    for _ in range(3):
+        for sink, command in zip(sinks, commands):
+            sink.start(command)
+            sink.write(command, b'x' * 100000)
+            sink.finish(command, Status('', '', 0))
+    lines = (tmp_path / 'log.jsonl').read_text().splitlines()
+    assert [json.loads(line)['host'] for line in lines] == \
+        ['myhost', 'otherhost'] * 3
+    for sink in sinks:
+        sink.close()
@@ -0,0 +1,50 @@
+import pytest
+
+import usine
+from usine import disabled_ciphers, tune
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr('usine.CACHE_DIR', tmp_path)
+    return tmp_path
+
+
+def test_default_profile(patch_client):
+    assert usine.client.get_profile() == {}
+
+
+def test_builtin_and_config_profiles(patch_client, monkeypatch):
+    usine.client.profile = 'slow'
+    assert usine.client.get_profile() == {'compress': True}
+    monkeypatch.setitem(usine.config, 'profiles',
+                        {'mine': {'window_size': '4M'}})
+    usine.client.profile = 'mine'
+    assert usine.client.get_profile() == {'window_size': '4M'}
+    usine.client.profile = 'unknown'
+    with pytest.raises(SystemExit):
+        usine.client.get_profile()
+
+
+def test_auto_profile_is_cached_per_host(patch_client, cache):
+    usine.client.profile = 'auto'
+    assert usine.client.get_profile() == {}
+    usine.write_cache('profiles', {'bar': {'compress': True}})
+    assert usine.client.get_profile() == {'compress': True}
+
+
+def test_disabled_ciphers():
+    assert disabled_ciphers(None) is None
+    assert disabled_ciphers(['unknown']) is None
+    disabled = disabled_ciphers(['aes128-ctr'])['ciphers']
+    assert 'aes128-ctr' not in disabled
+    assert 'aes256-ctr' in disabled
+
+
+def test_tune():
+    # Fast LAN: nothing to change.
+    assert tune(100 * 1024 ** 2, 0.001) == {}
+    # Slow link.
+    assert tune(200 * 1024, 0.05) == {'compress': True}
+    # Window bound long fat link.
+    assert tune(20 * 1024 ** 2, 0.1) == {'window_size': 16 * 1024 ** 2}
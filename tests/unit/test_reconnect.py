@@ -0,0 +1,133 @@
+import sys
+import time
+
+import paramiko
+import pytest
+
+import usine
+
+
+class Transport:
+
+    def __init__(self, active=True):
+        self.active = active
+        self.sessions = 0
+
+    def is_active(self):
+        return self.active
+
+    def open_session(self, timeout=None):
+        if not self.active:
+            raise EOFError()
+        self.sessions += 1
+        return self
+
+    def close(self):
+        pass
+
+
+class SSHClient:
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def transport(patch_client, monkeypatch):
+    def open_(self):
+        self._client = SSHClient()
+        self._transport = Transport()
+
+    monkeypatch.setattr('usine.Client.open', open_)
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+    usine.client._client = SSHClient()
+    usine.client._transport = Transport(active=False)
+    return usine.client
+
+
+def test_open_session_reconnects_dead_connection(transport):
+    channel = transport.open_session()
+    assert channel is transport._transport
+    assert channel.sessions == 1
+    assert transport.stats['reconnect']['count'] == 1
+
+
+def test_open_session_reuses_live_connection(transport):
+    transport._transport = live = Transport()
+    assert transport.open_session() is live
+    assert 'reconnect' not in transport.stats
+
+
+def test_retry_reconnects_on_connection_error(transport):
+    calls = []
+
+    @usine.retry
+    def operation():
+        calls.append(1)
+        if len(calls) < 3:
+            raise paramiko.SSHException('Server connection dropped')
+        return 'done'
+
+    assert operation() == 'done'
+    assert len(calls) == 3
+    assert transport.stats['reconnect']['count'] == 2
+
+
+def test_retry_is_bounded(transport, monkeypatch):
+    monkeypatch.setitem(usine.config, 'reconnect_retries', 1)
+
+    @usine.retry
+    def operation():
+        raise EOFError()
+
+    with pytest.raises(EOFError):
+        operation()
+    assert transport.stats['reconnect']['count'] == 1
+
+
+def test_retry_ignores_other_errors(transport):
+    transport._transport = Transport()
+
+    @usine.retry
+    def operation():
+        raise FileNotFoundError('missing')
+
+    with pytest.raises(FileNotFoundError):
+        operation()
+    assert 'reconnect' not in transport.stats
+
+
+def test_ensure_alive_reopens_persistent_shells(transport, monkeypatch):
+    monkeypatch.setattr('usine.Shell.__init__',
+                        lambda self, channel, prefix: setattr(self, 'prefix',
+                                                              prefix))
+    old = usine.client._shells['sudo'] = usine.Shell(None, 'sudo')
+    transport._used = time.monotonic()
+    transport.ensure_alive()
+    assert transport.stats['reconnect']['count'] == 1
+    assert transport._shells['sudo'] is not old
+
+
+def test_ensure_alive_skips_recently_used_connection(transport):
+    transport._transport = live = Transport()
+    transport._used = time.monotonic()
+    transport.ensure_alive()
+    assert live.sessions == 0
+    transport._used -= usine.IDLE_CHECK + 1
+    transport.ensure_alive()
+    assert live.sessions == 1
+    assert 'reconnect' not in transport.stats
+
+
+def test_shell_exists_raises_on_lost_connection(transport, monkeypatch):
+    def call(self, cmd, **kwargs):
+        sys.exit(-1)
+
+    monkeypatch.setattr('usine.Client.__call__', call)
+    fs = usine.ShellFS(transport)
+    with pytest.raises(ConnectionError):
+        fs.exists('/tmp')
+    with pytest.raises(ConnectionError):
+        fs.exists_many(['/tmp'])
+    transport._transport = Transport()
+    assert fs.exists('/tmp') is False
@@ -0,0 +1,79 @@
+import re
+
+import pytest
+
+import usine
+from usine import RemoteError, Shell
+
+
+class Channel:
+
+    def __init__(self, *outputs):
+        self.outputs = list(outputs)
+        self.sent = []
+        self.chunks = []
+
+    def exec_command(self, cmd):
+        self.command = cmd
+
+    def sendall(self, data):
+        self.sent.append(data.decode())
+        marker = re.search(r"printf '\\n(\w+) %d", self.sent[-1]).group(1)
+        output, code = self.outputs.pop(0)
+        # Simulate the output being received in small chunks.
+        data = f'{output}\n{marker} {code}\n'.encode()
+        self.chunks = [data[i:i + 3] for i in range(0, len(data), 3)]
+
+    def recv(self, size):
+        return self.chunks.pop(0) if self.chunks else b''
+
+
+def test_shell_runs_commands_in_one_channel():
+    channel = Channel(('foo\nbar\n', 0), ('', 2))
+    shell = Shell(channel, 'sudo --set-home')
+    assert channel.command == 'sudo --set-home bash --noprofile --norc'
+    written = []
+    status = shell("sh -c $'echo foo; echo bar'", written.append)
+    assert status.stdout == 'foo\nbar\n'
+    assert status.code == 0
+    assert channel.sent[0].startswith("sh -c $'echo foo; echo bar' "
+                                      "</dev/null 2>&1; ")
+    status = shell("sh -c $'false'", written.append)
+    assert status.stdout == ''
+    assert status.code == 2
+    assert not status
+    assert b''.join(written) == b'foo\nbar\n'
+
+
+class ClosedChannel(Channel):
+
+    stderr = b'sudo: a terminal is required to read the password\n'
+
+    def sendall(self, data):
+        pass
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv_stderr(self, size):
+        data, self.stderr = self.stderr, b''
+        return data
+
+    def close(self):
+        pass
+
+
+def test_shell_reports_why_the_session_closed():
+    shell = Shell(ClosedChannel(), 'sudo')
+    with pytest.raises(RemoteError, match='a terminal is required'):
+        shell('true', lambda data: None)
+
+
+def test_persistent_shell_fails_fast(patch_client, monkeypatch, capsys):
+    monkeypatch.setattr('usine.Client.open_session',
+                        lambda self: ClosedChannel())
+    with pytest.raises(SystemExit):
+        with usine.sudo(persistent=True):
+            pass
+    assert 'a terminal is required' in capsys.readouterr().out
+    assert not usine.client._shells
@@ -0,0 +1,48 @@
+from io import BytesIO, StringIO
+
+from usine import Feeder, iter_chunks
+
+
+class Channel:
+
+    def __init__(self, window=5):
+        self.window = window
+        self.received = b''
+        self.eof = False
+
+    def send_ready(self):
+        return True
+
+    def send(self, data):
+        data = data[:self.window]
+        self.received += data
+        return len(data)
+
+    def shutdown_write(self):
+        self.eof = True
+
+
+def test_iter_chunks_bytes():
+    assert list(iter_chunks(b'abcdefg', size=3)) == [b'abc', b'def', b'g']
+
+
+def test_iter_chunks_str():
+    assert list(iter_chunks('éa', size=2)) == [b'\xc3\xa9', b'a']
+
+
+def test_iter_chunks_files():
+    assert list(iter_chunks(BytesIO(b'abcd'), size=3)) == [b'abc', b'd']
+    assert list(iter_chunks(StringIO('abcd'), size=3)) == [b'abc', b'd']
+
+
+def test_iter_chunks_iterator_skips_empty_chunks():
+    assert list(iter_chunks(iter([b'ab', b'', 'c']))) == [b'ab', b'c']
+
+
+def test_feeder_streams_then_closes_write_side():
+    channel = Channel(window=4)
+    feeder = Feeder(channel, b'x' * 10)
+    while not feeder.done:
+        feeder.feed()
+    assert channel.received == b'x' * 10
+    assert channel.eof
@@ -1,24 +1,42 @@
+import codecs
+import functools
 import inspect
+import itertools
+import json
 import os
 import select
+import socket
+import stat
 import string
+import struct
 import sys
 import termios
+import threading
 import tty
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
+from concurrent.futures import as_completed as _as_completed
 from contextlib import contextmanager
 from getpass import getuser
 from hashlib import md5
 from io import BytesIO, StringIO
-from pathlib import Path
+from pathlib import Path, PurePosixPath
+from uuid import uuid4
 
 import paramiko
 import yaml
 from paramiko.client import SSHClient, WarningPolicy
 from paramiko.config import SSHConfig
+from paramiko.sftp import CMD_ATTRS, CMD_STAT
+from paramiko.sftp_attr import SFTPAttributes
 from progressist import ProgressBar
 
 client = None
+CHUNK_SIZE = 32768
+# Seconds a connection can stay idle before checking it before reuse.
+IDLE_CHECK = 5
+_output_lock = threading.Lock()  # Shared by concurrent channels.
 
 
 @contextmanager
@@ -38,6 +56,16 @@ def character_buffered():
         termios.tcsetattr(sys.stdin, termios.TCSADRAIN, old_settings)
 
 
+def human_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TiB'
+    return f'{size:.1f} {unit}'
+
+
 def gray(s):
     return f'\x1b[1;30m{s}\x1b[0m'
 
@@ -46,6 +74,505 @@ def red(s):
     return f'\x1b[1;41m{s}\x1b[0m'
 
 
+class Command:
+    """A command being run, as seen by the output sinks."""
+
+    counter = itertools.count(1)
+
+    def __init__(self, client, cmd, prefix=''):
+        self.id = next(self.counter)
+        self.hostname = client.hostname
+        self.cmd = cmd
+        self.prefix = prefix
+        self.started = time.time()
+
+
+class Sink:
+    """
+    Receive the commands and their output. Output chunks are raw bytes, as
+    read from the channel: formatting and flushing is up to each sink.
+    """
+
+    def start(self, command):
+        pass
+
+    def write(self, command, data):
+        pass
+
+    def idle(self, command):
+        """Called when the command is running but has no output for now."""
+
+    def finish(self, command, status):
+        pass
+
+    def message(self, text):
+        """A message from usine itself (eg. an SFTP operation)."""
+
+    def close(self):
+        pass
+
+
+class TerminalSink(Sink):
+    """
+    Write to ``sys.stdout``, at most every `interval` seconds (and when the
+    command is idle). Prefixed (background) commands are written line by
+    line, so concurrent commands never interleave partial lines.
+    """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.pending = {}
+        self.decoders = {}
+        self.flushed = {}
+
+    def _write(self, text):
+        with _output_lock:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+    def start(self, command):
+        self._write(gray(f'{command.prefix}{command.cmd}') + '\n')
+        self.pending[command] = bytearray()
+        self.decoders[command] = codecs.getincrementaldecoder('utf-8')(
+            errors='replace')
+        self.flushed[command] = time.monotonic()
+
+    def write(self, command, data):
+        pending = self.pending[command]
+        pending += data
+        if command.prefix:
+            *lines, rest = pending.split(b'\n')
+            if lines:
+                self.pending[command] = rest
+                self._write(''.join(
+                    f'{command.prefix}{line.decode(errors="replace")}\n'
+                    for line in lines))
+        elif time.monotonic() - self.flushed[command] > self.interval:
+            self.flush(command)
+
+    def flush(self, command, final=False):
+        pending = self.pending[command]
+        if pending and (final or not command.prefix):
+            text = self.decoders[command].decode(bytes(pending), final=final)
+            self._write(f'{command.prefix}{text}\n' if command.prefix
+                        else text)
+            pending.clear()
+        self.flushed[command] = time.monotonic()
+
+    def idle(self, command):
+        self.flush(command)
+
+    def finish(self, command, status):
+        self.flush(command, final=True)
+        del self.pending[command], self.decoders[command]
+        del self.flushed[command]
+
+    def message(self, text):
+        self._write(gray(text) + '\n')
+
+
+class QuietSink(Sink):
+    """Only show the failing commands, with their output."""
+
+    def __init__(self):
+        self.buffers = {}
+
+    def start(self, command):
+        self.buffers[command] = bytearray()
+
+    def write(self, command, data):
+        self.buffers[command] += data
+
+    def finish(self, command, status):
+        output = self.buffers.pop(command)
+        if not status:
+            with _output_lock:
+                print(gray(f'{command.prefix}{command.cmd}'))
+                print(output.decode(errors='replace'), flush=True)
+
+
+class LogSink(Sink):
+    """
+    Write the commands and their output to one log file per host, in
+    `directory`, or to one file per command when `per_command` is true.
+    """
+
+    def __init__(self, directory, per_command=False):
+        self.directory = Path(directory)
+        self.per_command = per_command
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def _file(self, command):
+        if self.per_command:
+            path = self.directory / command.hostname / f'{command.id:05d}.log'
+        else:
+            path = self.directory / f'{command.hostname}.log'
+        if path not in self.files:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.files[path] = path.open('ab', buffering=1024 ** 2)
+        return self.files[path]
+
+    def start(self, command):
+        with self.lock:
+            self._file(command).write(f'$ {command.cmd}\n'.encode())
+
+    def write(self, command, data):
+        with self.lock:
+            self._file(command).write(data)
+
+    def finish(self, command, status):
+        with self.lock:
+            fd = self._file(command)
+            fd.write(f'\n[exit {status.code}]\n'.encode())
+            if self.per_command:
+                fd.close()
+                del self.files[Path(fd.name)]
+
+    def close(self):
+        for fd in self.files.values():
+            fd.close()
+        self.files.clear()
+
+
+class JSONLinesSink(Sink):
+    """
+    Append one JSON object per command to `path`. Each record is written
+    whole, without buffering, so the sinks of many clients can share the
+    same file.
+    """
+
+    lock = threading.Lock()  # Shared by all the instances.
+
+    def __init__(self, path):
+        self.fd = Path(path).open('ab', buffering=0)
+        self.buffers = {}
+
+    def start(self, command):
+        self.buffers[command] = bytearray()
+
+    def write(self, command, data):
+        self.buffers[command] += data
+
+    def finish(self, command, status):
+        record = {'host': command.hostname, 'command': command.cmd,
+                  'started': command.started,
+                  'duration': time.time() - command.started,
+                  'code': status.code,
+                  'stdout': self.buffers.pop(command).decode(errors='replace'),
+                  'stderr': status.stderr}
+        with self.lock:
+            self.fd.write((json.dumps(record) + '\n').encode())
+
+    def close(self):
+        self.fd.close()
+
+
+class Output(Sink):
+    """Dispatch to many sinks."""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def start(self, command):
+        for sink in self.sinks:
+            sink.start(command)
+
+    def write(self, command, data):
+        for sink in self.sinks:
+            sink.write(command, data)
+
+    def idle(self, command):
+        for sink in self.sinks:
+            sink.idle(command)
+
+    def finish(self, command, status):
+        for sink in self.sinks:
+            sink.finish(command, status)
+
+    def message(self, text):
+        for sink in self.sinks:
+            sink.message(text)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def iter_chunks(source, size=CHUNK_SIZE):
+    """Yield non empty bytes chunks from a file, bytes, str or iterator."""
+    if isinstance(source, str):
+        source = source.encode()
+    if isinstance(source, (bytes, bytearray)):
+        for idx in range(0, len(source), size):
+            yield bytes(source[idx:idx + size])
+        return
+    if hasattr(source, 'read'):
+        read = source.read
+        source = iter(lambda: read(size), read(0))
+    for chunk in source:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        if chunk:
+            yield chunk
+
+
+class Feeder:
+    """
+    Stream a stdin `source` into a channel, sending only what the channel
+    window accepts (so we never block while output is pending), and closing
+    the channel write side at EOF.
+    """
+
+    def __init__(self, channel, source, throttle=None):
+        self.channel = channel
+        self.chunks = iter_chunks(source)
+        self.pending = b''
+        self.done = False
+        self.throttle = throttle
+
+    def feed(self):
+        if self.done:
+            return
+        if not self.pending:
+            self.pending = next(self.chunks, b'')
+            if not self.pending:
+                self.channel.shutdown_write()
+                self.done = True
+                return
+        if self.channel.send_ready():
+            sent = self.channel.send(self.pending)
+            self.pending = self.pending[sent:]
+            if self.throttle:
+                self.throttle(sent)
+
+
+class Shell:
+    """
+    A long-lived shell, run on its own channel, commands are fed into one
+    after the other. Each command output is followed by a unique marker and
+    its exit code, so we know where it ends.
+    """
+
+    def __init__(self, channel, prefix=''):
+        self.channel = channel
+        self.prefix = prefix
+        channel.exec_command(f'{prefix} bash --noprofile --norc'.strip())
+
+    def __call__(self, cmd, write):
+        marker = uuid4().hex
+        try:
+            # Do not let the command consume the next ones from stdin.
+            self.channel.sendall(f"{cmd} </dev/null 2>&1; "
+                                 f"printf '\\n{marker} %d\\n' $?\n".encode())
+        except OSError:
+            raise self.closed()
+        end = f'\n{marker} '.encode()
+        output = bytearray()
+        printed = 0
+        while True:
+            data = self.channel.recv(CHUNK_SIZE)
+            if not data:
+                raise self.closed()
+            output += data
+            idx = output.find(end)
+            if idx != -1 and output.endswith(b'\n'):
+                break
+            # Hold back the last newline: it may be the marker's one.
+            last = output.rfind(b'\n')
+            if idx == -1 and last > printed:
+                write(bytes(output[printed:last]))
+                printed = last
+        write(bytes(output[printed:idx]))
+        code = int(output[idx + len(end):].strip())
+        return Status(output[:idx].decode(), '', code)
+
+    def closed(self):
+        """Return the error explaining why the session closed (eg. sudo
+        requiring a password or a tty)."""
+        stderr = b''
+        while self.channel.recv_stderr_ready():
+            stderr += self.channel.recv_stderr(CHUNK_SIZE)
+        return RemoteError(stderr.decode(errors='replace').strip()
+                           or 'Shell session closed')
+
+    def close(self):
+        self.channel.close()
+
+
+# Standalone helper, uploaded and run on the remote server by `Agent`.
+AGENT = r'''
+import grp, hashlib, json, os, pwd, shutil, stat, struct, sys
+
+
+def read(size):
+    data = b''
+    while len(data) < size:
+        chunk = sys.stdin.buffer.read(size - len(data))
+        if not chunk:
+            sys.exit(0)
+        data += chunk
+    return data
+
+
+def send(payload):
+    data = json.dumps(payload).encode()
+    sys.stdout.buffer.write(struct.pack('>I', len(data)) + data)
+    sys.stdout.buffer.flush()
+
+
+def to_dict(st):
+    return {'mode': st.st_mode, 'size': st.st_size, 'mtime': st.st_mtime,
+            'uid': st.st_uid, 'gid': st.st_gid,
+            'is_dir': stat.S_ISDIR(st.st_mode)}
+
+
+def ping():
+    return 'pong'
+
+
+def exists(path):
+    return os.path.exists(path)
+
+
+def stat_(path):
+    try:
+        return to_dict(os.stat(path))
+    except FileNotFoundError:
+        return None
+
+
+def hash_(path, algorithm='sha256'):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def mkdir(path, parents=True, mode=None):
+    mode = int(str(mode), 8) if mode else 0o777
+    if parents:
+        os.makedirs(path, mode, exist_ok=True)
+    else:
+        os.mkdir(path, mode)
+
+
+def chown(path, owner, recursive=True):
+    user, _, group = owner.partition(':')
+    uid = pwd.getpwnam(user).pw_uid if user else -1
+    gid = grp.getgrnam(group).gr_gid if group else -1
+    os.chown(path, uid, gid)
+    if recursive and os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                os.lchown(os.path.join(root, name), uid, gid)
+
+
+def rename(src, dest):
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    shutil.move(src, dest)
+
+
+def copy(src, dest):
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    if os.path.isdir(src):
+        shutil.copytree(src, dest, symlinks=True)
+    else:
+        shutil.copy2(src, dest)
+
+
+def listdir(path):
+    if not os.path.isdir(path):  # Like ls, list the file itself.
+        entry = to_dict(os.lstat(path))
+        entry['name'] = path
+        return [entry]
+    entries = []
+    for name in sorted(os.listdir(path)):
+        entry = to_dict(os.lstat(os.path.join(path, name)))
+        entry['name'] = name
+        entries.append(entry)
+    return entries
+
+
+def batch(requests):
+    return [call(request) for request in requests]
+
+
+OPS = {'ping': ping, 'exists': exists, 'stat': stat_, 'hash': hash_,
+       'mkdir': mkdir, 'chown': chown, 'rename': rename, 'copy': copy,
+       'listdir': listdir, 'batch': batch}
+PATHS = {'exists', 'stat', 'hash', 'mkdir', 'chown', 'rename', 'copy',
+         'listdir'}
+
+
+def call(request):
+    op = request['op']
+    args = request.get('args', [])
+    if op in PATHS:
+        args = [os.path.expanduser(args[0])] + args[1:]
+        if op in ('rename', 'copy'):
+            args[1] = os.path.expanduser(args[1])
+    try:
+        return {'result': OPS[op](*args, **request.get('kwargs', {}))}
+    except Exception as err:
+        return {'error': '{}: {}'.format(type(err).__name__, err)}
+
+
+if __name__ == '__main__':
+    os.unlink(__file__)  # Running, we do not need it anymore.
+    while True:
+        size, = struct.unpack('>I', read(4))
+        send(call(json.loads(read(size).decode())))
+'''
+
+
+class Agent:
+    """
+    Client side of the remote helper: requests and responses are JSON
+    payloads, each one prefixed with its length.
+    """
+
+    def __init__(self, channel, exit):
+        self.channel = channel
+        self.exit = exit
+        self.lock = threading.Lock()
+
+    def _read(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.channel.recv(size - len(data))
+            if not chunk:
+                raise RemoteError('Agent session closed')
+            data += chunk
+        return data
+
+    def request(self, op, *args, **kwargs):
+        data = json.dumps({'op': op, 'args': args, 'kwargs': kwargs}).encode()
+        with self.lock:
+            self.channel.sendall(struct.pack('>I', len(data)) + data)
+            size, = struct.unpack('>I', self._read(4))
+            return json.loads(self._read(size).decode())
+
+    def __call__(self, op, *args, **kwargs):
+        response = self.request(op, *args, **kwargs)
+        if 'error' in response:
+            self.exit(response['error'])
+        return response['result']
+
+    def batch(self, requests):
+        """Run many `(op, args, kwargs)` requests in one round trip, and
+        return their responses."""
+        return self.request('batch', [
+            {'op': op, 'args': args, 'kwargs': kwargs}
+            for op, args, kwargs in requests])['result']
+
+    def close(self):
+        self.channel.close()
+
+
 class RemoteError(Exception):
     pass
 
@@ -66,6 +593,137 @@ class Config(dict):
 config = Config()  # singleton.
 
 
+def parse_size(value):
+    """Parse a size in bytes, like 512, '64K' or '10M'."""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = str(value).strip().upper().rstrip('B')
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+class TokenBucket:
+    """
+    Limit a throughput to `rate` bytes per second (no limit when `None`).
+    `rate` can be changed at any time. Consumers are granted at most `burst`
+    bytes at once, and then wait for their turn, so concurrent transfers
+    share the bandwidth fairly.
+
+    The throughput is measured over the current (or last) activity period:
+    it restarts after `idle` seconds without transfer.
+    """
+
+    idle = 1
+
+    def __init__(self, rate=None, burst=CHUNK_SIZE):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+        self.transferred = 0
+        self.started = None  # Start of the current activity period.
+        self.used = None  # Last consumption.
+        self.active = 0  # Bytes transferred during the activity period.
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, value):
+        self._rate = parse_size(value)
+
+    def consume(self, size):
+        with self.lock:
+            now = time.monotonic()
+            if self.started is None or now - self.used > self.idle:
+                self.started = now
+                self.active = 0
+            self.used = now
+            self.transferred += size
+            self.active += size
+        while size > 0 and self.rate:
+            with self.lock:
+                now = time.monotonic()
+                capacity = max(self.burst, self.rate / 10)
+                self.tokens = min(self.tokens + (now - self.last) * self.rate,
+                                  capacity)
+                self.last = now
+                grant = min(size, self.burst)
+                self.tokens -= grant
+                wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            size -= grant
+            if wait:
+                time.sleep(wait)
+                with self.lock:
+                    self.used = max(self.used, time.monotonic())
+
+    @property
+    def throughput(self):
+        """Achieved throughput of the current (or last) activity period, in
+        bytes per second."""
+        if self.started is None:
+            return 0
+        return self.active / max(self.used - self.started, 1e-6)
+
+
+bandwidth = TokenBucket()  # Global limit, shared by all clients.
+
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME',
+                                Path.home() / '.cache')) / 'usine'
+
+
+def read_cache(name):
+    try:
+        with (CACHE_DIR / f'{name}.json').open() as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache(name, data):
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with (CACHE_DIR / f'{name}.json').open('w') as fd:
+        json.dump(data, fd)
+
+
+# Transport settings: window_size, max_packet_size, compress and ciphers.
+PROFILES = {
+    'default': {},
+    # Fast local network: CPU bound, so prefer the cheapest ciphers.
+    'lan': {'window_size': '8M',
+            'ciphers': ['aes128-gcm@openssh.com', 'aes128-ctr']},
+    # Long fat network: keep enough data in flight to fill the link.
+    'wan': {'window_size': '32M'},
+    # Slow link: trade some CPU for less bytes on the wire.
+    'slow': {'compress': True},
+}
+
+
+def disabled_ciphers(ciphers):
+    """Return paramiko `disabled_algorithms` allowing only `ciphers`."""
+    available = paramiko.Transport._preferred_ciphers
+    if not ciphers or not set(ciphers) & set(available):
+        return None
+    return {'ciphers': [c for c in available if c not in ciphers]}
+
+
+def tune(rate, rtt, window_size=paramiko.common.DEFAULT_WINDOW_SIZE):
+    """Choose transport settings from a measured throughput (bytes per
+    second) and round trip time (seconds)."""
+    settings = {}
+    if rate < 1024 ** 2:
+        settings['compress'] = True
+    # When data in flight fills the window, it is the bottleneck.
+    if rate * rtt > window_size / 2:
+        settings['window_size'] = min(max(int(rate * rtt * 8), window_size),
+                                      64 * 1024 ** 2)
+    return settings
+
+
 class Template(string.Template):
     # Default delimiter ($) clashes at least with Nginx DSL.
     delimiter = '$$'
@@ -146,10 +804,11 @@ def formattable(func):
 
 class Status:
 
-    def __init__(self, stdout, stderr, exit_status):
+    def __init__(self, stdout, stderr, exit_status, data=None):
         self.stderr = stderr
         self.stdout = stdout
         self.code = exit_status
+        self.data = data  # Structured result, when available.
 
     def __contains__(self, other):
         return other in self.stdout
@@ -164,11 +823,615 @@ class Status:
         return self.code == 0
 
 
+def staging_path(path):
+    """Hidden temporary path next to `path`, to write it before moving it
+    into place."""
+    path = PurePosixPath(str(path))
+    digest = md5(str(path).encode()).hexdigest()
+    return path.with_name(f'.{path.name}.{digest}')
+
+
+def sftp_path(path):
+    """SFTP paths are relative to the home directory, and do not expand
+    `~`."""
+    path = str(path)
+    if path == '~':
+        return '.'
+    if path.startswith('~/'):
+        return path[2:]
+    return path
+
+
+def shell_word(path):
+    """Double quote `path`, leaving a leading `~` expandable."""
+    path = str(path)
+    if path == '~' or path.startswith('~/'):
+        return f'~"{path[1:]}"'
+    return f'"{path}"'
+
+
+def stat_dict(st):
+    return {'mode': st.st_mode, 'size': st.st_size, 'mtime': st.st_mtime,
+            'uid': st.st_uid, 'gid': st.st_gid,
+            'is_dir': stat.S_ISDIR(st.st_mode)}
+
+
+class SFTPResponses(dict):
+    """Collect the responses of pipelined SFTP requests, by number."""
+
+    def _async_response(self, t, msg, num):
+        self[num] = (t, msg)
+
+
+class ShellFS:
+    """
+    File operations run as shell commands, so they work in any context
+    (sudo, screen, dry run…). This is the fallback of other backends.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def exists(self, path):
+        try:
+            self.client(f'test -e {path}', readonly=True)
+        except SystemExit:
+            self._check_connection()
+            return False
+        return not self.client.dry_run
+
+    def _check_connection(self):
+        """Tell a lost connection from a failed command."""
+        if not self.client.dry_run and not self.client._transport.is_active():
+            raise ConnectionError(f'Connection to {self.client.hostname} lost')
+
+    @formattable
+    def mkdir(self, path, parents=True, mode=None):
+        return self.client('mkdir {parents:bool} {mode:equal} {path}')
+
+    @formattable
+    def chown(self, mode, path, recursive=True, preserve_root=True):
+        return self.client('chown {recursive:bool} {mode} {path}')
+
+    @formattable
+    def ls(self, path, all=True, human_readable=True, size=True, list=True):
+        return self.client('ls {all:bool} {human_readable:bool} {size:bool} '
+                           '{list:initial} {path}', readonly=True)
+
+    def mv(self, src, dest):
+        return self.client(f'mv {src} {dest}')
+
+    def _many(self, paths, test):
+        """Run `test` on each path (as `$p`) in one command, and return
+        its output lines."""
+        words = ' '.join(shell_word(path) for path in paths)
+        try:
+            ret = self.client(f'for p in {words}; do {test}; done; true',
+                              readonly=True)
+        except SystemExit:
+            self._check_connection()
+            raise
+        if self.client.dry_run:
+            return ['-'] * len(paths)
+        return [line.strip() for line in ret.stdout.splitlines()]
+
+    def exists_many(self, paths):
+        lines = self._many(paths, '[ -e "$p" ] && echo 1 || echo -')
+        return {path: line == '1' for path, line in zip(paths, lines)}
+
+    def stat_many(self, paths):
+        lines = self._many(paths, 'stat -L -c "%f %s %Y %u %g" "$p" '
+                                  '2>/dev/null || echo -')
+        stats = {}
+        for path, line in zip(paths, lines):
+            if line == '-':
+                stats[path] = None
+                continue
+            mode, size, mtime, uid, gid = line.split()
+            mode = int(mode, 16)
+            stats[path] = {'mode': mode, 'size': int(size),
+                           'mtime': int(mtime), 'uid': int(uid),
+                           'gid': int(gid), 'is_dir': stat.S_ISDIR(mode)}
+        return stats
+
+    def hash_many(self, paths, algorithm='sha256'):
+        lines = self._many(paths, f'({algorithm}sum "$p" 2>/dev/null '
+                                  f'|| echo -) | cut -d" " -f1')
+        return {path: None if line == '-' else line
+                for path, line in zip(paths, lines)}
+
+    @formattable
+    def cp(self, src, dest, interactive=False, recursive=True, link=False,
+           update=False):
+        return self.client('cp {interactive:bool} {recursive:bool} '
+                           '{link:bool} {update:bool} {src} {dest}')
+
+
+class SFTPFS(ShellFS):
+    """
+    SFTP native operations, one request each, when running as the SSH user.
+    """
+
+    def _path(self, path):
+        return sftp_path(self.client.path(path))
+
+    def _call(self, name, *args):
+        self.client.cache.clear()
+        self.client.output.message(
+            f'[sftp] {name} {" ".join(str(arg) for arg in args)}')
+        try:
+            return getattr(self.client.sftp, name)(*args)
+        except IOError as err:
+            self.client.exit(f'{args[0]}: {err}')
+
+    def stat(self, path):
+        return self._stat(self._path(path))
+
+    def _stat(self, path):
+        """Stat an already resolved path."""
+        try:
+            return self.client.sftp.stat(str(path))
+        except IOError:
+            if not self.client._transport.is_active():
+                raise  # Not a missing file, a lost connection.
+            return None
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def stat_many(self, paths):
+        """Send all the stat requests at once, then read the responses."""
+        sftp = self.client.sftp
+        self.client.output.message(f'[sftp] stat {len(paths)} paths')
+        responses = SFTPResponses()
+        numbers = [sftp._async_request(responses, CMD_STAT,
+                                       sftp._adjust_cwd(self._path(path)))
+                   for path in paths]
+        stats = {}
+        for path, number in zip(paths, numbers):
+            while number not in responses:
+                sftp._read_response()
+            t, msg = responses.pop(number)
+            stats[path] = (stat_dict(SFTPAttributes._from_msg(msg))
+                           if t == CMD_ATTRS else None)
+        return stats
+
+    def exists_many(self, paths):
+        return {path: st is not None
+                for path, st in self.stat_many(paths).items()}
+
+    def mkdir(self, path, parents=True, mode=None):
+        if mode is not None and not str(mode).isdigit():
+            return super().mkdir(path, parents=parents, mode=mode)
+        mode = int(str(mode), 8) if mode else 0o777
+        path = PurePosixPath(self._path(path))
+        if not parents:
+            self._call('mkdir', str(path), mode)
+            return Status('', '', 0)
+        for parent in [*reversed(path.parents), path]:
+            if str(parent) not in ('.', '/') and not self._stat(parent):
+                self._call('mkdir', str(parent), mode)
+        return Status('', '', 0)
+
+    def mv(self, src, dest):
+        source, target = self._path(src), self._path(dest)
+        rstat = self.stat(dest)
+        if rstat and stat.S_ISDIR(rstat.st_mode):
+            target = str(PurePosixPath(target) / PurePosixPath(source).name)
+        self.client.cache.clear()
+        try:
+            self.client.sftp.posix_rename(source, target)
+        except IOError:  # Eg. cross device or no posix-rename extension.
+            return super().mv(src, dest)
+        self.client.output.message(f'[sftp] posix_rename {source} {target}')
+        return Status('', '', 0)
+
+
+class AgentFS(ShellFS):
+    """Operations answered by the remote helper agent."""
+
+    def __init__(self, client, agent):
+        super().__init__(client)
+        self._agent = agent
+
+    def agent(self, op, *args, **kwargs):
+        if op not in ('exists', 'listdir'):
+            self.client.cache.clear()
+        self.client.output.message(
+            f'[agent] {op} {" ".join(str(arg) for arg in args)}')
+        return self._agent(op, *args, **kwargs)
+
+    def exists(self, path):
+        return self.agent('exists', self.client.path(path))
+
+    def mkdir(self, path, parents=True, mode=None):
+        if mode is not None and not str(mode).isdigit():
+            return super().mkdir(path, parents=parents, mode=mode)
+        self.agent('mkdir', self.client.path(path), parents=parents,
+                   mode=mode)
+        return Status('', '', 0)
+
+    def chown(self, mode, path, recursive=True, preserve_root=True):
+        self.agent('chown', self.client.path(path), mode, recursive=recursive)
+        return Status('', '', 0)
+
+    def ls(self, path, all=True, human_readable=True, size=True, list=True):
+        entries = self.agent('listdir', self.client.path(path))
+        if not all:
+            entries = [e for e in entries if not e['name'].startswith('.')]
+        lines = [e['name'] for e in entries]
+        if list:
+            sizes = [human_size(e['size']) if human_readable else e['size']
+                     for e in entries]
+            lines = [f"{stat.filemode(e['mode'])} {s} {e['name']}"
+                     for e, s in zip(entries, sizes)]
+        stdout = '\n'.join(lines)
+        self.client.output.message(stdout)
+        return Status(stdout, '', 0, data=entries)
+
+    def mv(self, src, dest):
+        self.agent('rename', self.client.path(src), self.client.path(dest))
+        return Status('', '', 0)
+
+    def _many(self, op, paths, *args):
+        self.client.output.message(f'[agent] {op} {len(paths)} paths')
+        responses = self._agent.batch([(op, [self.client.path(path), *args],
+                                        {}) for path in paths])
+        return {path: response.get('result')
+                for path, response in zip(paths, responses)}
+
+    def exists_many(self, paths):
+        return self._many('exists', paths)
+
+    def stat_many(self, paths):
+        return self._many('stat', paths)
+
+    def hash_many(self, paths, algorithm='sha256'):
+        return self._many('hash', paths, algorithm)
+
+    def cp(self, src, dest, interactive=False, recursive=True, link=False,
+           update=False):
+        if not recursive or interactive or link or update:
+            return super().cp(src, dest, interactive=interactive,
+                              recursive=recursive, link=link, update=update)
+        self.agent('copy', self.client.path(src), self.client.path(dest))
+        return Status('', '', 0)
+
+
+FACTS = {}  # name: (command, parser)
+
+
+def fact(name, command):
+    """
+    Register a fact collector: `command` is added to the facts probe script,
+    and its output is parsed by the decorated function.
+    """
+    def register(parse):
+        FACTS[name] = (command, parse)
+        return parse
+    return register
+
+
+@fact('hostname', 'hostname')
+def hostname_fact(output):
+    return output
+
+
+@fact('kernel', 'uname -srm')
+def kernel_fact(output):
+    name, release, machine = output.split()
+    return {'name': name, 'release': release, 'machine': machine}
+
+
+@fact('os', 'cat /etc/os-release')
+def os_fact(output):
+    values = {}
+    for line in output.splitlines():
+        key, _, value = line.partition('=')
+        if value:
+            values[key.lower()] = value.strip('"')
+    return values
+
+
+@fact('user', 'id -u; id -un; id -gn')
+def user_fact(output):
+    uid, name, group = output.split()
+    return {'uid': int(uid), 'name': name, 'group': group}
+
+
+@fact('python', 'python3 --version 2>&1')
+def python_fact(output):
+    return output.split()[-1] if output.startswith('Python') else None
+
+
+@fact('disk', 'df -Pk')
+def disk_fact(output):
+    disks = []
+    for line in output.splitlines()[1:]:
+        filesystem, size, used, available, _, mountpoint = line.split(None, 5)
+        disks.append({'filesystem': filesystem, 'size': int(size) * 1024,
+                      'used': int(used) * 1024,
+                      'available': int(available) * 1024,
+                      'mountpoint': mountpoint})
+    return disks
+
+
+def probe_script(marker, names):
+    lines = []
+    for name in names:
+        lines.append(f"printf '\\n{marker} {name}\\n'")
+        lines.append(f'({FACTS[name][0]}) 2>/dev/null')
+    return '\n'.join(lines) + '\n'
+
+
+def parse_probe(output, marker):
+    facts = {}
+    for section in output.split(f'\n{marker} ')[1:]:
+        name, _, value = section.partition('\n')
+        try:
+            facts[name] = FACTS[name][1](value.strip())
+        except Exception:  # Missing tool, unexpected format…
+            facts[name] = None
+    return facts
+
+
+def make_output():
+    """Build the output sinks from the config."""
+    sinks = [QuietSink() if config.quiet
+             else TerminalSink(config.output_interval or 0.1)]
+    if config.log_dir:
+        sinks.append(LogSink(config.log_dir, bool(config.log_per_command)))
+    if config.json_log:
+        sinks.append(JSONLinesSink(config.json_log))
+    return Output(sinks)
+
+
+def resolve_host(spec, ssh_config):
+    """Return hostname, username, port and key files of a `user@host:port`
+    spec, as defined by the SSH config."""
+    parsed = Client.parse_host(spec)
+    lookup = ssh_config.lookup(parsed['hostname'])
+    return (lookup['hostname'],
+            parsed['username'] or lookup.get('user', getuser()),
+            parsed['port'] or int(lookup.get('port', 22)),
+            lookup.get('identityfile', []))
+
+
+class Bastion:
+    """
+    A jump host connection, pooled and shared by all the clients connecting
+    through it (targets are then reached through `direct-tcpip` channels).
+
+    `config.jump_max_targets` limits the number of targets concurrently
+    connecting (key exchange and authentication) through one bastion.
+    """
+
+    pool = {}
+    lock = threading.Lock()
+
+    def __init__(self, key, spec, ssh_config, sock=None):
+        self.key = key
+        self.users = 0
+        self.slots = (threading.BoundedSemaphore(config.jump_max_targets)
+                      if config.jump_max_targets else None)
+        self.connect(*resolve_host(spec, ssh_config), sock=sock)
+
+    def connect(self, hostname, username, port, key_filenames, sock=None):
+        self._client = SSHClient()
+        self._client.load_system_host_keys()
+        self._client.set_missing_host_key_policy(WarningPolicy())
+        print(f'Connecting to bastion {username}@{hostname}')
+        self._client.connect(hostname=hostname, port=port, username=username,
+                             sock=sock, key_filename=key_filenames)
+        self.transport = self._client.get_transport()
+
+    def is_active(self):
+        return self.transport.is_active()
+
+    @contextmanager
+    def handshake(self):
+        """Wait for a free `jump_max_targets` slot while a target connects
+        through this bastion."""
+        if self.slots:
+            self.slots.acquire()
+        try:
+            yield
+        finally:
+            if self.slots:
+                self.slots.release()
+
+    def open_channel(self, hostname, port):
+        return self.transport.open_channel('direct-tcpip', (hostname, port),
+                                           ('', 0))
+
+    def close(self):
+        if self.pool.get(self.key) is self:
+            del self.pool[self.key]
+        self._client.close()
+
+    @classmethod
+    def acquire(cls, jumps, ssh_config):
+        """Return the chain of bastions for `jumps`, each one connected
+        through the previous one, reusing pooled connections."""
+        chain = []
+        with cls.lock:
+            try:
+                for idx, spec in enumerate(jumps):
+                    key = tuple(jumps[:idx + 1])
+                    bastion = cls.pool.get(key)
+                    if not bastion or not bastion.is_active():
+                        sock = None
+                        if chain:
+                            hostname, _, port, _ = resolve_host(spec,
+                                                                ssh_config)
+                            sock = chain[-1].open_channel(hostname, port)
+                        bastion = cls(key, spec, ssh_config, sock)
+                        cls.pool[key] = bastion
+                    bastion.users += 1
+                    chain.append(bastion)
+            except BaseException:  # Do not leak the hops already connected.
+                cls._unref(chain)
+                raise
+        return chain
+
+    @classmethod
+    def release(cls, chain):
+        with cls.lock:
+            cls._unref(chain)
+
+    @classmethod
+    def _unref(cls, chain):
+        for bastion in reversed(chain):
+            bastion.users -= 1
+            if not bastion.users:
+                bastion.close()
+
+
+class StatusCache:
+    """
+    Least recently used cache of command statuses, by namespace, bounded by
+    the total size of their output.
+    """
+
+    def __init__(self, max_size='16M'):
+        self.max_size = parse_size(max_size)
+        self.entries = OrderedDict()  # (namespace, command): status
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(status):
+        return len(status.stdout) + len(status.stderr)
+
+    def get(self, key):
+        with self.lock:
+            status = self.entries.get(key)
+            if status is not None:
+                self.entries.move_to_end(key)
+            return status
+
+    def set(self, key, status):
+        size = self._sizeof(status)
+        if size > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self._sizeof(self.entries.pop(key))
+            self.entries[key] = status
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self._sizeof(evicted)
+
+    def clear(self, namespace=None):
+        with self.lock:
+            for key in list(self.entries):
+                if namespace is None or key[0] == namespace:
+                    self.size -= self._sizeof(self.entries.pop(key))
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def load_key(path):
+    """Load a private key file, whatever its type, or return None (eg. when
+    it is missing or encrypted)."""
+    for klass in (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey):
+        try:
+            return klass.from_private_key_file(os.path.expanduser(path))
+        except (paramiko.SSHException, OSError, ValueError):
+            continue
+    return None
+
+
+class ProfiledSSHClient(SSHClient):
+    """
+    An SSHClient timing the key exchange, the host key check and the
+    authentication, and trying first the key (file or agent one) that last
+    succeeded for this host.
+    """
+
+    lock = threading.Lock()  # Around the auth cache updates.
+
+    def __init__(self, host, timings):
+        super().__init__()
+        self.host = host  # user@host:port, the auth cache key.
+        self.timings = timings
+        self.started = None
+        self.exchanged = None  # End of the key exchange.
+
+    @property
+    def _transport(self):
+        return self.__dict__['_transport']
+
+    @_transport.setter
+    def _transport(self, transport):
+        # Set by SSHClient.connect just before it starts the key exchange,
+        # then checks the host key: time the former to tell them apart.
+        if transport is not None:
+            start_client = transport.start_client
+
+            @functools.wraps(start_client)
+            def timed(*args, **kwargs):
+                start_client(*args, **kwargs)
+                self.exchanged = time.perf_counter()
+                self.timings['kex'] = self.exchanged - self.started
+
+            transport.start_client = timed
+        self.__dict__['_transport'] = transport
+
+    def connect(self, *args, **kwargs):
+        self.started = time.perf_counter()
+        return super().connect(*args, **kwargs)
+
+    def _auth(self, username, password, pkey, key_filenames, allow_agent,
+              *args):
+        start = time.perf_counter()
+        self.timings['hostkey'] = start - (self.exchanged or self.started)
+        agent = paramiko.Agent() if allow_agent and pkey is None else None
+        candidates = [(os.path.expanduser(path), None)
+                      for path in key_filenames or []]
+        if agent:
+            candidates += [(f'agent:{key.get_fingerprint().hex()}', key)
+                           for key in agent.get_keys()]
+        last = read_cache('auth').get(self.host)
+        candidates.sort(key=lambda candidate: candidate[0] != last)
+        tried = []
+        for name, key in candidates if pkey is None else []:
+            key = key or load_key(name)
+            if key is None:  # Leave it to paramiko (passphrase…).
+                continue
+            tried.append(name)
+            try:
+                self._transport.auth_publickey(username, key)
+            except paramiko.AuthenticationException:
+                continue
+            if self._transport.is_authenticated():
+                self.remember(name)
+                break
+        else:
+            remaining = [path for path in key_filenames or []
+                         if os.path.expanduser(path) not in tried]
+            super()._auth(username, password, pkey, remaining,
+                          allow_agent and agent is None, *args)
+        if agent:
+            agent.close()
+        self.timings['auth'] = time.perf_counter() - start
+
+    def remember(self, name):
+        with self.lock:
+            methods = read_cache('auth')
+            if methods.get(self.host) != name:
+                methods[self.host] = name
+                write_cache('auth', methods)
+
+
 class Client:
 
     context = {}
 
-    def __init__(self, hostname, configpath=None, dry_run=False):
+    def __init__(self, hostname, configpath=None, dry_run=False, agent=False,
+                 lazy=False):
         ssh_config = SSHConfig()
         if not hostname:
             print(red('"hostname" must be defined'))
@@ -183,11 +1446,14 @@ class Client:
                 self._load_config(path, hostname)
         with (Path.home() / '.ssh/config').open() as fd:
             ssh_config.parse(fd)
+        self._ssh_config = ssh_config
         ssh_config = ssh_config.lookup(hostname)
         self.dry_run = dry_run
         self.hostname = config.hostname or ssh_config['hostname']
         self.username = (username or config.username
                          or ssh_config.get('user', getuser()))
+        self.port = (parsed.get('port') or config.port
+                     or int(ssh_config.get('port', 22)))
         self.formatter = Formatter()
         self.key_filenames = []
         if config.key_filename:
@@ -199,30 +1465,219 @@ class Client:
         self.screen = None
         self.env = {}
         self._sftp = None
+        self._executor = None
+        self._submitted = 0
+        self._shells = {}
+        self.bandwidth = TokenBucket(config.bandwidth)
+        self._facts = None
+        self.output = make_output()
+        self.cache = StatusCache(config.cache_size or '16M')
+        self.caching = None  # Namespace, when in a cached_remote function.
+        self.use_agent = agent or bool(config.agent)
+        self._agent = None
         self.proxy_command = ssh_config.get('proxycommand',
                                             config.proxy_command)
-        self.open()
+        self.proxy_jump = config.proxy_jump or ssh_config.get('proxyjump')
+        if isinstance(self.proxy_jump, str):
+            self.proxy_jump = [jump.strip()
+                               for jump in self.proxy_jump.split(',')]
+        if self.proxy_jump == ['none']:
+            self.proxy_jump = None
+        self._jumps = None
+        self.profile = config.profile or 'default'
+        self.timeout = config.connect_timeout
+        self.stats = {}
+        if not lazy:
+            self.open()
 
     def open(self):
-        self._client = SSHClient()
+        timings = self.stats['connect'] = {}
+        start = time.perf_counter()
+        self._client = ProfiledSSHClient(
+            f'{self.username}@{self.hostname}:{self.port}', timings)
         self._client.load_system_host_keys()
         self._client.set_missing_host_key_policy(WarningPolicy())
         print(f'Connecting to {self.username}@{self.hostname}')
+        if self.proxy_jump:
+            print('ProxyJump:', ','.join(self.proxy_jump))
+            self._jumps = Bastion.acquire(self.proxy_jump, self._ssh_config)
+        settings = self.get_profile()
+        try:
+            self._connect(settings, timings)
+        except BaseException:  # Including sys.exit.
+            self._client.close()
+            if self._jumps:
+                Bastion.release(self._jumps)
+                self._jumps = None
+            raise
+        timings['total'] = time.perf_counter() - start
+        print('Connected in', ', '.join(f'{name} {duration * 1000:.0f}ms'
+                                        for name, duration in timings.items()))
+        self._transport = self._client.get_transport()
+        self._used = time.monotonic()
+        if config.keepalive:
+            self._transport.set_keepalive(config.keepalive)
+        if (self.profile == 'auto'
+                and self.hostname not in read_cache('profiles')):
+            settings = self.benchmark()
+        self._apply_profile(settings)
+
+    def _connect(self, settings, timings):
+        if self._jumps:
+            with self._jumps[-1].handshake():
+                sock = self._jumps[-1].open_channel(self.hostname, self.port)
+                self._handshake(sock, settings)
+            return
         if self.proxy_command:
             print('ProxyCommand:', self.proxy_command)
-        sock = (paramiko.ProxyCommand(self.proxy_command)
-                if self.proxy_command else None)
+            sock = paramiko.ProxyCommand(self.proxy_command)
+        else:
+            sock = self._open_socket(timings)
+        self._handshake(sock, settings)
+
+    def _handshake(self, sock, settings):
         try:
-            self._client.connect(hostname=self.hostname,
-                                 username=self.username, sock=sock,
-                                 key_filename=self.key_filenames)
+            self._client.connect(
+                hostname=self.hostname, port=self.port,
+                username=self.username, sock=sock,
+                key_filename=self.key_filenames, timeout=self.timeout,
+                banner_timeout=self.timeout, auth_timeout=self.timeout,
+                compress=settings.get('compress', False),
+                disabled_algorithms=disabled_ciphers(settings.get('ciphers')))
         except paramiko.ssh_exception.BadHostKeyException:
             sys.exit('Connection error: bad host key')
-        self._transport = self._client.get_transport()
+
+    def _open_socket(self, timings):
+        """Resolve and connect to the host, timing both steps."""
+        start = time.perf_counter()
+        try:
+            addresses = socket.getaddrinfo(self.hostname, self.port,
+                                           type=socket.SOCK_STREAM)
+        except socket.gaierror as err:
+            sys.exit(f'Connection error: {err}')
+        timings['dns'] = time.perf_counter() - start
+        start = time.perf_counter()
+        for family, type_, proto, _, address in addresses:
+            sock = socket.socket(family, type_, proto)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(address)
+            except OSError as err:
+                sock.close()
+                error = err
+                continue
+            timings['tcp'] = time.perf_counter() - start
+            return sock
+        sys.exit(f'Connection error: {error}')
+
+    def open_session(self):
+        """Open a channel, reconnecting first if the connection is dead
+        (or does not answer within `config.channel_timeout` seconds)."""
+        start = time.perf_counter()
+        if self._transport.is_active():
+            try:
+                return self._transport.open_session(
+                    timeout=config.channel_timeout or 10)
+            except (paramiko.SSHException, EOFError, OSError):
+                pass
+        self.reconnect(detection=time.perf_counter() - start)
+        return self._transport.open_session(
+            timeout=config.channel_timeout or 10)
+
+    def ensure_alive(self):
+        """Before reusing a long-lived channel (persistent shell, agent),
+        check that a connection idle for a while still answers, and
+        reconnect otherwise (which reopens those channels)."""
+        if (not self._transport.is_active()
+                or time.monotonic() - self._used > IDLE_CHECK):
+            self.open_session().close()
+        self._used = time.monotonic()
+
+    def reconnect(self, detection=0):
+        """Open a new connection, and restore the SFTP session, agent and
+        persistent shells on it (lazily for the first two)."""
+        print(red(f'Connection to {self.hostname} lost, reconnecting'))
+        start = time.perf_counter()
+        self._sftp = None
+        self._agent = None
+        prefixes = list(self._shells)
+        self._shells.clear()
+        self._client.close()
+        if self._jumps:
+            Bastion.release(self._jumps)
+            self._jumps = None
+        self.open()
+        for prefix in prefixes:
+            self._shells[prefix] = Shell(self.open_session(), prefix)
+        stats = self.stats.setdefault(
+            'reconnect', {'count': 0, 'detection': 0, 'recovery': 0})
+        stats['count'] += 1
+        stats['detection'] += detection
+        stats['recovery'] += time.perf_counter() - start
+
+    def get_profile(self):
+        """Return the transport settings of the configured profile."""
+        if isinstance(self.profile, dict):
+            return self.profile
+        if self.profile == 'auto':
+            return read_cache('profiles').get(self.hostname, {})
+        profiles = {**PROFILES, **(config.profiles or {})}
+        if self.profile not in profiles:
+            self.exit(f'Unknown profile "{self.profile}"')
+        return profiles[self.profile]
+
+    def _apply_profile(self, settings):
+        # Used by each channel (and SFTP session) opened from now on.
+        if settings.get('window_size'):
+            self._transport.default_window_size = parse_size(
+                settings['window_size'])
+        if settings.get('max_packet_size'):
+            self._transport.default_max_packet_size = parse_size(
+                settings['max_packet_size'])
+
+    def benchmark(self, size=4 * 1024 ** 2, timeout=2):
+        """Measure round trip time and throughput, and cache the transport
+        settings chosen from them for this host. The compression choice only
+        applies from the next connection."""
+        start = time.perf_counter()
+        self._exec('true')
+        rtt = time.perf_counter() - start
+        channel = self.open_session()
+        channel.exec_command(f'head -c {size} /dev/zero')
+        received = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < timeout:
+            data = channel.recv(CHUNK_SIZE)
+            if not data:
+                break
+            received += len(data)
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        channel.close()
+        rate = received / elapsed
+        settings = tune(rate, rtt, self._transport.default_window_size)
+        print(f'Benchmark: {human_size(rate)}/s, rtt {rtt * 1000:.0f}ms, '
+              f'settings: {settings or "default"}')
+        profiles = read_cache('profiles')
+        profiles[self.hostname] = settings
+        write_cache('profiles', profiles)
+        return settings
 
     def close(self):
         print(f'\nDisconnecting from {self.username}@{self.hostname}')
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+        if self._agent:
+            self._agent.close()
+            self._agent = None
+        for shell in self._shells.values():
+            shell.close()
+        self._shells.clear()
         self._client.close()
+        self.output.close()
+        if self._jumps:
+            Bastion.release(self._jumps)
+            self._jumps = None
 
     def _load_config(self, path, hostname):
         with Path(path).open() as fd:
@@ -231,7 +1686,8 @@ class Client:
                 conf.update(conf[hostname])
             config.update(conf)
 
-    def parse_host(self, host_string):
+    @staticmethod
+    def parse_host(host_string):
         user_hostport = host_string.rsplit('@', 1)
         hostport = user_hostport.pop()
         user = user_hostport[0] if user_hostport and user_hostport[0] else None
@@ -266,68 +1722,265 @@ class Client:
             cmd = f'screen -UD -RR -S {self.screen} {cmd}'
         return cmd.strip().replace('  ',  ' ')
 
-    def _call_command(self, cmd, **kwargs):
-        channel = self._transport.open_session()
-        try:
-            size = os.get_terminal_size()
-        except IOError:
-            channel.get_pty()  # Fails when ran from pytest.
-        else:
-            channel.get_pty(width=size.columns, height=size.lines)
+    def _call_command(self, cmd, stdin=None, command=None, **kwargs):
+        command = command or Command(self, cmd)
+        channel = self.open_session()
+        if stdin is None:
+            try:
+                size = os.get_terminal_size()
+            except IOError:
+                channel.get_pty()  # Fails when ran from pytest.
+            else:
+                channel.get_pty(width=size.columns, height=size.lines)
         channel.exec_command(cmd)
         channel.setblocking(False)  # Allow to read from empty buffer.
-        stdout = channel.makefile('r', -1)
         stderr = channel.makefile_stderr('r', -1)
-        proxy_stdout = b''
-        buf = b''
+        feeder = (Feeder(channel, stdin, self.throttle)
+                  if stdin is not None else None)
+        stdout = []
+        proxy_stderr = b''
         while True:
-            while sys.stdin in select.select([sys.stdin], [], [], 0)[0]:
+            if feeder:
+                feeder.feed()
+                # No pty: drain stderr so the remote never blocks on it.
+                if channel.recv_stderr_ready():
+                    proxy_stderr += channel.recv_stderr(CHUNK_SIZE)
+            while not feeder and sys.stdin in select.select([sys.stdin], [],
+                                                            [], 0)[0]:
                 # TODO compute bytes_to_read like in invoke?
                 data = sys.stdin.read(1)
                 if data:
                     channel.sendall(data)
                 else:
                     break
-            if not channel.recv_ready():
-                if buf:  # We may have read some buffer yet, let's output it.
-                    sys.stdout.write(buf.decode())
-                    sys.stdout.flush()
-                    buf = b''
-                if channel.exit_status_ready():
-                    break
-                continue
-            try:
-                data = stdout.read(1)
-            except Exception:  # Not sure how to catch socket.timeout properly.
-                pass
-            else:
-                proxy_stdout += data
-                buf += data
-                if data == b'\n':
-                    sys.stdout.write(buf.decode())
-                    sys.stdout.flush()
-                    buf = b''
+            if channel.recv_ready():
+                data = channel.recv(CHUNK_SIZE)
+                stdout.append(data)
+                self.output.write(command, data)
                 continue
+            self.output.idle(command)
+            if channel.exit_status_ready():
+                break
             time.sleep(paramiko.io_sleep)
         channel.setblocking(True)  # Make sure we now wait for stderr.
-        ret = Status(proxy_stdout.decode(), stderr.read().decode().strip(),
+        proxy_stderr += stderr.read()
+        ret = Status(b''.join(stdout).decode(), proxy_stderr.decode().strip(),
                      channel.recv_exit_status())
         channel.close()
+        self.output.finish(command, ret)
         if ret.code:
             self.exit(ret.stderr, ret.code)
         return ret
 
+    def _exec(self, cmd, write=None, stdin=None):
+        """
+        Run `cmd` on its own channel, without pty nor local stdin, and
+        return its `Status` (even on failure).
+        """
+        channel = self.open_session()
+        channel.exec_command(cmd)
+        feeder = Feeder(channel, stdin or b'', self.throttle)
+        stdout = bytearray()
+        stderr = bytearray()
+        while True:
+            feeder.feed()
+            if channel.recv_ready():
+                data = channel.recv(CHUNK_SIZE)
+                stdout += data
+                if write:
+                    write(data)
+            elif channel.recv_stderr_ready():
+                stderr += channel.recv_stderr(CHUNK_SIZE)
+            elif channel.exit_status_ready():
+                break
+            else:
+                time.sleep(paramiko.io_sleep)
+        ret = Status(stdout.decode(), stderr.decode().strip(),
+                     channel.recv_exit_status())
+        channel.close()
+        return ret
+
+    def _background(self, command, stdin=None):
+        ret = self._exec(command.cmd, stdin=stdin,
+                         write=lambda data: self.output.write(command, data))
+        self.output.finish(command, ret)
+        if ret.code:
+            with _output_lock:
+                self.exit(f'{command.prefix}{ret.stderr}', ret.code)
+        return ret
+
+    @property
+    def executor(self):
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(
+                max_workers=config.max_channels or 8)
+        return self._executor
+
+    def submit(self, cmd, prefix=None, stdin=None, **kwargs):
+        # Build now, so sudo/cd/env are the ones active at submit time.
+        cmd = self._build_command(cmd, **kwargs)
+        self.cache.clear()
+        self._submitted += 1
+        if prefix is None:
+            prefix = f'[{self.hostname}#{self._submitted}] '
+        command = Command(self, cmd, prefix)
+        self.output.start(command)
+        if self.dry_run:
+            future = Future()
+            future.set_result(Status('¡DRY RUN!', '¡DRY RUN!', 0))
+            self.output.finish(command, future.result())
+            return future
+        return self.executor.submit(self._background, command, stdin)
+
+    def open_shell(self):
+        """Open a persistent shell for the current sudo context, unless
+        already open. Return whether a shell has been opened."""
+        prefix = self.format(self.sudo or '')
+        if prefix in self._shells:
+            return False
+        shell = self._shells[prefix] = Shell(self.open_session(), prefix)
+        try:
+            shell('true', write=lambda data: None)  # Fail fast.
+        except RemoteError as err:
+            del self._shells[prefix]
+            shell.close()
+            self.exit(f'Unable to open a persistent shell: {err}')
+        return True
+
+    def close_shell(self):
+        self._shells.pop(self.format(self.sudo or '')).close()
+
+    def _get_shell(self, stdin=None, **kwargs):
+        if self._shells and not self.screen and stdin is None:
+            return self._shells.get(self.format(self.sudo or ''))
+
+    def get_facts(self, refresh=False):
+        """
+        Return facts about the remote host, gathered by one probe script,
+        and cached locally for `config.facts_ttl` seconds (default: 3600).
+        """
+        entry = self._facts or read_cache('facts').get(self.hostname)
+        ttl = config.facts_ttl or 3600
+        if (refresh or not entry or time.time() - entry['time'] > ttl
+                or set(FACTS) - set(entry['facts'])):
+            marker = uuid4().hex
+            print(gray(f'Gathering facts ({", ".join(FACTS)})'))
+            ret = self._exec('sh -s', stdin=probe_script(marker, FACTS))
+            entry = {'time': time.time(),
+                     'facts': parse_probe(ret.stdout, marker)}
+            cache = read_cache('facts')
+            cache[self.hostname] = entry
+            write_cache('facts', cache)
+        self._facts = entry
+        return entry['facts']
+
+    @property
+    def facts(self):
+        return self.get_facts()
+
+    def throttle(self, size):
+        """Wait until `size` bytes can be sent or received."""
+        self.bandwidth.consume(size)
+        bandwidth.consume(size)
+
+    @property
+    def throttled(self):
+        return bool(self.bandwidth.rate or bandwidth.rate)
+
+    @property
+    def fs(self):
+        """Return the file operations backend for the current context."""
+        if self.sudo or self.screen or self.dry_run:
+            return ShellFS(self)
+        agent = self.get_agent()
+        if agent:
+            return AgentFS(self, agent)
+        return SFTPFS(self)
+
+    def get_agent(self):
+        """Return the remote helper agent, if enabled, starting it if
+        needed."""
+        if not self.use_agent:
+            return None
+        if self._agent:
+            self.ensure_alive()
+        if not self._agent:
+            path = f'/tmp/usine-agent-{uuid4().hex}.py'
+            self.sftp.putfo(BytesIO(AGENT.encode()), path)
+            channel = self.open_session()
+            channel.exec_command(f'python3 {path}')
+            self._agent = Agent(channel, self.exit)
+            try:
+                self._agent.request('ping')
+            except RemoteError:
+                print(red('Unable to start the agent, falling back to shell'))
+                self._agent = None
+                self.use_agent = False
+        return self._agent
+
+    def path(self, path):
+        if self.cd and not str(path).startswith(('/', '~')):
+            path = Path(self.cd) / path
+        return str(path)
+
     def exit(self, msg, code=1):
         print(red(msg))
         sys.exit(code)
 
-    def __call__(self, cmd, **kwargs):
+    def __call__(self, cmd, cache=None, readonly=False, **kwargs):
+        """
+        Run `cmd`. With `cache` (`True` or a namespace, default to the one
+        of the current `cached_remote` function), the status is memoized by
+        the fully built command, unless `cmd` reads `stdin`. Any other
+        command, unless `readonly`, clears the cache.
+        """
+        if cache is None:
+            cache = self.caching
+        if cache and kwargs.get('stdin') is None and not self.dry_run:
+            namespace = 'default' if cache is True else cache
+            key = (namespace, self._build_command(cmd, **kwargs))
+            status = self.cache.get(key)
+            if status is not None:
+                self.output.message(f'[cached] {key[1]}')
+                return status
+            status = self._run(cmd, **kwargs)
+            self.cache.set(key, status)
+            return status
+        if not readonly:
+            self.cache.clear()
+        return self._run(cmd, **kwargs)
+
+    def _run(self, cmd, **kwargs):
+        if self._get_shell(**kwargs):
+            self.ensure_alive()
+        shell = self._get_shell(**kwargs)
+        if shell:
+            previous, self.sudo = self.sudo, None  # Shell is already sudoed.
+            cmd = self._build_command(cmd, **kwargs)
+            self.sudo = previous
+            command = Command(self, cmd)
+            command.cmd = f'{shell.prefix}> {cmd}'
+            self.output.start(command)
+            try:
+                ret = shell(cmd, write=lambda data: self.output.write(command,
+                                                                      data))
+            except RemoteError as err:
+                self.exit(str(err))
+            self.output.finish(command, ret)
+            if ret.code:
+                # Stderr is merged into stdout, show the end of the output.
+                tail = ret.stdout.strip().splitlines()[-5:]
+                self.exit('\n'.join(tail) or cmd, ret.code)
+            return ret
         cmd = self._build_command(cmd, **kwargs)
-        print(gray(cmd))
+        command = Command(self, cmd)
+        self.output.start(command)
         if self.dry_run:
-            return Status('¡DRY RUN!', '¡DRY RUN!', 0)
+            ret = Status('¡DRY RUN!', '¡DRY RUN!', 0)
+            self.output.finish(command, ret)
+            return ret
         with character_buffered():
-            return self._call_command(cmd, **kwargs)
+            return self._call_command(cmd, command=command, **kwargs)
 
     def format(self, tpl):
         try:
@@ -338,11 +1991,43 @@ class Client:
 
     @property
     def sftp(self):
-        if not self._sftp:
-            self._sftp = self._client.open_sftp()
+        if not self._sftp or self._sftp.sock.closed:
+            channel = self.open_session()
+            channel.invoke_subsystem('sftp')
+            self._sftp = paramiko.SFTPClient(channel)
         return self._sftp
 
 
+def is_connection_error(err):
+    return (isinstance(err, (paramiko.SSHException, EOFError, socket.timeout,
+                             ConnectionError))
+            or isinstance(err, OSError) and not client._transport.is_active())
+
+
+def retry(func):
+    """
+    Decorator retrying an idempotent operation when the connection is lost,
+    reconnecting after an exponential backoff, at most
+    `config.reconnect_retries` times (default: 3).
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        retries = config.reconnect_retries
+        retries = 3 if retries is None else retries
+        for attempt in itertools.count():
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                if attempt >= retries or not is_connection_error(err):
+                    raise
+                detection = time.perf_counter() - start
+            time.sleep(min(0.5 * 2 ** attempt, 10))
+            client.reconnect(detection=detection)
+
+    return wrapper
+
+
 @contextmanager
 def connect(*args, **kwargs):
     enter(*args, **kwargs)
@@ -350,6 +2035,26 @@ def connect(*args, **kwargs):
     exit()
 
 
+def connect_many(hostnames, **kwargs):
+    """
+    Open the connections to `hostnames` concurrently (at most
+    `config.max_connections` at once), and return their clients, in order.
+    """
+    clients = [Client(hostname, lazy=True, **kwargs) for hostname in hostnames]
+    workers = min(config.max_connections or 16, len(clients) or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(instance.open) for instance in clients]
+    try:
+        for future in futures:
+            future.result()
+    except BaseException:
+        for instance, future in zip(clients, futures):
+            if not future.exception():
+                instance.close()
+        raise
+    return clients
+
+
 def enter(*args, **kwargs):
     global client
     klass = kwargs.pop('client', Client)
@@ -360,46 +2065,99 @@ def exit():
     client.close()
 
 
-def run(cmd):
-    return client(cmd)
+def run(cmd, stdin=None, cache=None):
+    return client(cmd, stdin=stdin, cache=cache)
+
+
+def cached_remote(namespace='default'):
+    """
+    Decorator memoizing every `run` of the decorated function (in
+    `namespace`), for the rest of the session.
+    """
+    if callable(namespace):  # Used without arguments.
+        return cached_remote()(namespace)
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            previous, client.caching = client.caching, namespace
+            try:
+                return func(*args, **kwargs)
+            finally:
+                client.caching = previous
+
+        return wrapper
+
+    return decorator
+
+
+def clear_cache(namespace=None):
+    client.cache.clear(namespace)
+
+
+def submit(cmd, prefix=None, stdin=None):
+    return client.submit(cmd, prefix=prefix, stdin=stdin)
+
+
+def gather(*futures):
+    return [future.result() for future in futures]
+
+
+def as_completed(futures, timeout=None):
+    return _as_completed(futures, timeout=timeout)
+
 
+def facts(refresh=False):
+    return client.get_facts(refresh=refresh)
 
+
+@retry
 def exists(path):
-    try:
-        run(f'test -e {path}')
-    except SystemExit:
-        return False
-    return not client.dry_run
+    return client.fs.exists(path)
+
+
+@retry
+def exists_many(paths):
+    return client.fs.exists_many(list(paths))
+
+
+@retry
+def stat_many(paths):
+    return client.fs.stat_many(list(paths))
+
+
+@retry
+def hash_many(paths, algorithm='sha256'):
+    return client.fs.hash_many(list(paths), algorithm=algorithm)
 
 
-@formattable
 def mkdir(path, parents=True, mode=None):
-    return run('mkdir {parents:bool} {mode:equal} {path}')
+    return client.fs.mkdir(path, parents=parents, mode=mode)
 
 
-@formattable
 def chown(mode, path, recursive=True, preserve_root=True):
-    return run('chown {recursive:bool} {mode} {path}')
+    return client.fs.chown(mode, path, recursive=recursive,
+                           preserve_root=preserve_root)
 
 
-@formattable
 def ls(path, all=True, human_readable=True, size=True, list=True):
-    return run('ls {all:bool} {human_readable:bool} {size:bool} {list:initial}'
-               ' {path}')
+    return client.fs.ls(path, all=all, human_readable=human_readable,
+                        size=size, list=list)
 
 
 def mv(src, dest):
-    return run(f'mv {src} {dest}')
+    return client.fs.mv(src, dest)
 
 
-@formattable
 def cp(src, dest, interactive=False, recursive=True, link=False, update=False):
-    return run('cp {interactive:bool} {recursive:bool} {link:bool} '
-               '{update:bool} {src} {dest}')
+    return client.fs.cp(src, dest, interactive=interactive,
+                        recursive=recursive, link=link, update=update)
 
 
 def put(local, remote, force=False):
     user = client.context.get('user')
+    remote = Path(remote)
     if client.cd:
         remote = Path(client.cd) / remote
     if not hasattr(local, 'read'):
@@ -415,7 +2173,7 @@ def put(local, remote, force=False):
             return
         if not force and exists(remote):
             lstat = os.stat(str(local))
-            rstat = client.sftp.stat(str(remote))
+            rstat = client.sftp.stat(sftp_path(remote))
             if (lstat.st_size == rstat.st_size
                and lstat.st_mtime <= rstat.st_mtime):
                 print(f'{local} => {remote}: SKIPPING (reason: up to date)')
@@ -432,14 +2190,18 @@ def put(local, remote, force=False):
     if client.dry_run:
         print(bar.prefix)
         return
-    tmp = str(Path('/tmp') / md5(str(remote).encode()).hexdigest())
+    # Upload next to the target, so the final rename is atomic.
+    tmp = staging_path(remote)
+    client.cache.clear()
     try:
-        func(local, tmp,
-             callback=lambda done, total: bar.update(done=done, total=total),
-             confirm=True)
+        func(local, sftp_path(tmp), callback=progress(bar), confirm=True)
     except OSError as err:
         print(red(f'Error while processing {remote}'))
         print(red(err))
+        try:  # Do not leave a partial file in the target directory.
+            client.sftp.remove(sftp_path(tmp))
+        except OSError:
+            pass
         sys.exit(1)
     if hasattr(local, 'read'):
         bar.finish()
@@ -449,11 +2211,48 @@ def put(local, remote, force=False):
             chown(user, remote)
 
 
+def progress(bar):
+    """Return a transfer callback updating `bar` and enforcing the
+    bandwidth limits."""
+    last = 0
+
+    def callback(done, total):
+        nonlocal last
+        client.throttle(done - last)
+        last = done
+        bar.update(done=done, total=total)
+
+    return callback
+
+
+def getfo(remote, local, callback):
+    """Like `SFTPClient.getfo`, but without prefetching the whole file, so
+    the bandwidth limits apply to the network too."""
+    with client.sftp.open(remote, 'rb') as remote_file:
+        total = remote_file.stat().st_size
+        done = 0
+        for chunk in iter(lambda: remote_file.read(CHUNK_SIZE), b''):
+            local.write(chunk)
+            done += len(chunk)
+            callback(done, total)
+
+
 def get(remote, local):
     if client.cd:
         remote = Path(client.cd) / remote
+    if client.throttled and not hasattr(local, 'read'):
+        with Path(local).open('wb') as fd:
+            return _get(remote, fd, 0)
+    _get(remote, local, local.tell() if hasattr(local, 'read') else None)
+
+
+@retry
+def _get(remote, local, position=None):
+    if position is not None:  # Drop what a failed attempt has written.
+        local.seek(position)
+        local.truncate()
     if hasattr(local, 'read'):
-        func = client.sftp.getfo
+        func = getfo if client.throttled else client.sftp.getfo
         bar = ProgressBar(prefix=f'Reading from {remote}',
                           animation='{spinner}',
                           template='{prefix} {animation} {done:B}')
@@ -462,15 +2261,144 @@ def get(remote, local):
                           template='{prefix} {animation} {percent} '
                                    '({done:B}/{total:B}) ETA: {eta}')
         func = client.sftp.get
-    func(str(remote), local,
-         callback=lambda done, total: bar.update(done=done, total=total))
+    func(sftp_path(remote), local, callback=progress(bar))
     if hasattr(local, 'read'):
         local.seek(0)
         bar.finish()
 
 
+def transfer(src_client, src_path, dst_client, dst_path, direct=False):
+    """
+    Copy a file or a directory (as a tar stream) from one remote server to
+    another, without staging it on the local machine.
+
+    By default, the source command output is piped, chunk by chunk, into the
+    destination command input through the two SSH connections. With
+    `direct=True`, the source server pushes the data itself to the
+    destination one through `ssh`, so it must be allowed to connect to it.
+    """
+    if src_client.cd:
+        src_path = Path(src_client.cd) / src_path
+    if dst_client.cd:
+        dst_path = Path(dst_client.cd) / dst_path
+    kind = src_client._exec(src_client._build_command(
+        f'if [ -d {src_path} ]; then echo dir; '
+        f'elif [ -r {src_path} ]; then echo file; fi')).stdout.strip()
+    if not kind:
+        src_client.exit(f'{src_path}: no such file or not readable')
+    # Received next to the target, and moved into place once complete.
+    tmp = staging_path(dst_path)
+    if kind == 'dir':
+        send = f'tar -C {src_path} -cf - .'
+        receive = f'mkdir -p {tmp} && tar -C {tmp} -xf -'
+        commit = (f'mkdir -p {dst_path} && cp -a {tmp}/. {dst_path}/ '
+                  f'&& rm -rf {tmp}')
+    else:
+        send = f'cat {src_path}'
+        receive = f'cat > {tmp}'
+        commit = f'mv {tmp} {dst_path}'
+
+    def land(ok):
+        ret = dst_client._exec(dst_client._build_command(
+            commit if ok else f'rm -rf {tmp}'))
+        if ok and ret.code:
+            dst_client.exit(ret.stderr, ret.code)
+
+    prefix = (f'{src_client.hostname}:{src_path} => '
+              f'{dst_client.hostname}:{dst_path}')
+    if src_client.dry_run or dst_client.dry_run:
+        print(prefix)
+        return Status('¡DRY RUN!', '¡DRY RUN!', 0)
+    dst_client.cache.clear()
+    if direct:
+        # Will be nested in the source $'…' string.
+        receive = dst_client._build_command(receive).replace("'", "\\'")
+        target = f'{dst_client.username}@{dst_client.hostname}'
+        du = src_client._exec(src_client._build_command(f'du -sb {src_path}'))
+        # Without pipefail, the pipeline status is the ssh one: keep the
+        # sender one aside.
+        sent = f'/tmp/usine-{uuid4().hex}'
+        start = time.perf_counter()
+        try:
+            ret = src_client(
+                f'({send}; echo $? > {sent}) | ssh -p {dst_client.port} '
+                f'{target} "{receive}"; code=$?; status=$(cat {sent}); '
+                f'rm -f {sent}; [ $code = 0 ] && [ "$status" = 0 ]')
+        except SystemExit:
+            land(False)
+            raise
+        land(True)
+        size = int(du.stdout.split()[0]) if du.stdout[:1].isdigit() else 0
+        return transferred(ret, prefix, size, start)
+    bar = ProgressBar(prefix=prefix, animation='{spinner}',
+                      template='{prefix} {animation} {done:B}')
+    source = src_client.open_session()
+    source.exec_command(src_client._build_command(send))
+    dest = dst_client.open_session()
+    dest.exec_command(dst_client._build_command(receive))
+    start = time.perf_counter()
+    size = 0
+    pending = b''
+    stderr = {source: bytearray(), dest: bytearray()}
+    # Drain every stream of both channels, so none of the remote processes
+    # blocks on a full window.
+    while not dest.exit_status_ready():
+        busy = False
+        for channel in (source, dest):
+            if channel.recv_stderr_ready():
+                stderr[channel] += channel.recv_stderr(CHUNK_SIZE)
+                busy = True
+        if dest.recv_ready():
+            dest.recv(CHUNK_SIZE)  # Nothing expected, but do not block.
+            busy = True
+        eof = source.eof_received
+        if not pending and source.recv_ready():
+            pending = source.recv(CHUNK_SIZE)
+            size += len(pending)
+            src_client.bandwidth.consume(len(pending))
+            dst_client.throttle(len(pending))
+            bar.update(done=size)
+            busy = True
+        elif not pending and eof:
+            break
+        if pending and dest.send_ready():
+            pending = pending[dest.send(pending):]
+            busy = True
+        if not busy:
+            time.sleep(paramiko.io_sleep)
+    dest.shutdown_write()
+    codes = {}
+    while len(codes) < 2:
+        for channel in (source, dest):
+            while channel.recv_stderr_ready():
+                stderr[channel] += channel.recv_stderr(CHUNK_SIZE)
+            while channel.recv_ready():
+                channel.recv(CHUNK_SIZE)
+            if channel.exit_status_ready():
+                codes[channel] = channel.recv_exit_status()
+        time.sleep(paramiko.io_sleep)
+    bar.finish()
+    land(not any(codes.values()))
+    for remote, channel in ((src_client, source), (dst_client, dest)):
+        channel.close()
+        if codes[channel]:
+            remote.exit(stderr[channel].decode().strip(), codes[channel])
+    return transferred(Status('', '', 0), prefix, size, start)
+
+
+def transferred(ret, prefix, size, start):
+    """Report the size and throughput of a transfer, also available as
+    `ret.data`."""
+    elapsed = max(time.perf_counter() - start, 1e-6)
+    print(f'{prefix}: {human_size(size)} in {elapsed:.1f}s '
+          f'({human_size(size / elapsed)}/s)')
+    ret.data = {'size': size, 'elapsed': elapsed}
+    return ret
+
+
 @contextmanager
-def sudo(set_home=True, preserve_env=True, user=None, login=None):
+def sudo(set_home=True, preserve_env=True, user=None, login=None,
+         persistent=False):
     prefix = ('sudo {set_home:bool} {preserve_env:bool} {user:equal} '
               '{login:bool}')
     if login is None:
@@ -484,11 +2412,22 @@ def sudo(set_home=True, preserve_env=True, user=None, login=None):
         'login': login
     })
     client.sudo = prefix
+    opened = persistent and not client.dry_run and client.open_shell()
     yield
+    if opened:
+        client.close_shell()
     client.sudo = previous
     client.context = previous_context
 
 
+@contextmanager
+def throttle(rate):
+    previous = client.bandwidth.rate
+    client.bandwidth.rate = rate
+    yield
+    client.bandwidth.rate = previous
+
+
 @contextmanager
 def unsudo():
     previous = client.sudo